@@ -0,0 +1,59 @@
+"""
+Import-time benchmark.
+
+Each module is imported in a fresh interpreter so nothing is cached between
+runs. Reports the median wall time of the import itself and which of the
+heavy GUI/BLE dependencies it dragged in.
+
+    python benchmarks/bench_import.py [-n RUNS] [module ...]
+"""
+
+import argparse
+import statistics
+import subprocess
+import sys
+
+Heavy = ("numpy", "bokeh", "tornado", "adafruit_ble", "multiprocess")
+
+Probe = """
+import sys, time
+t = time.perf_counter()
+import {module}
+t = time.perf_counter() - t
+print(t, ",".join(m for m in {heavy!r} if m in sys.modules))
+"""
+
+
+def measure(module, runs):
+    times = []
+    loaded = ""
+    for _ in range(runs):
+        out = subprocess.run(
+            [sys.executable, "-c", Probe.format(module=module, heavy=Heavy)],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout.split()
+        times.append(float(out[0]))
+        loaded = out[1] if len(out) > 1 else ""
+    return statistics.median(times), loaded
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("-n", "--runs", type=int, default=10)
+    parser.add_argument(
+        "modules",
+        nargs="*",
+        default=["ppgview", "ppgview.command", "ppgview.packet", "ppgview.app"],
+    )
+    args = parser.parse_args()
+
+    print(f"{'module':<20} {'median (ms)':>12}  heavy imports")
+    for module in args.modules:
+        t, loaded = measure(module, args.runs)
+        print(f"{module:<20} {t * 1000:>12.1f}  {loaded or '-'}")
+
+
+if __name__ == "__main__":
+    main()
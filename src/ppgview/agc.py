@@ -0,0 +1,148 @@
+import time
+import logging
+
+import numpy as np
+
+from ppgview import command, packet
+
+# ADC full-scale ranges (nA), smallest first.
+ADCRanges = (2048, 4096, 8192, 16384)
+
+# LED pulse amplitude register limits. A register of 0 turns the LED off, so
+# the loop never goes below 1.
+MinPA = 1
+MaxPA = 255
+
+# Channels whose LED current the loop controls, and the register for each.
+LEDChannels = (
+    ("red", command.Command.RedLEDPA),
+    ("ir", command.Command.IRLEDPA),
+)
+
+
+class LEDController:
+    """
+    Closed-loop LED current and ADC range control.
+
+    Runs on every packet in the ingest process. Signal level is measured as
+    a fraction of ADC full scale for all channels at once: DC level (mean),
+    AC amplitude (peak-to-peak) and the number of samples near full scale.
+    While the peak level (DC + AC/2) stays inside [low, high] nothing
+    happens. Outside the band the LED current is scaled towards the middle
+    of the band, at most doubling or halving per step. If a channel clips at
+    minimum current the ADC range is widened; if all LED channels are starved
+    at maximum current it is narrowed.
+
+    After a command is sent for a channel, that channel waits until a
+    packet header shows the new setting and another `settle` packets have
+    been measured, and commands are never sent more often than every
+    `min_interval` seconds.
+    """
+
+    def __init__(
+        self,
+        low=0.3,
+        high=0.8,
+        clip_level=0.98,
+        max_clipped=0,
+        settle=1,
+        min_interval=0.25,
+        timeout=3.0,
+    ):
+        self.log = logging.getLogger("agc")
+        self.low = low
+        self.high = high
+        self.target = (low + high) / 2
+        self.clip_level = clip_level
+        self.max_clipped = max_clipped
+        self.settle = settle
+        self.min_interval = min_interval
+        self.timeout = timeout
+        self.reset()
+
+    def reset(self):
+        # Pending command per setting: (expected value, time sent, packets to wait).
+        self.pending = {}
+        self.last_sent = float("-inf")
+
+    def measure(self, pkt):
+        # Raw counts divided by full scale, no need to go through µA.
+        x = pkt.samples / float(2**packet.ADCBits)
+        dc = x.mean(axis=1)
+        ac = np.ptp(x, axis=1)
+        clipped = np.count_nonzero(x >= self.clip_level, axis=1)
+        return dc, ac, clipped
+
+    def update(self, pkt, now=None):
+        """Return the commands to send in response to this packet."""
+        now = time.monotonic() if now is None else now
+        current = {
+            command.Command.RedLEDPA: pkt.red_pa,
+            command.Command.IRLEDPA: pkt.ir_pa,
+            command.Command.ADCRange: pkt.adc_range,
+        }
+
+        # Hold off any setting that hasn't been applied and measured yet.
+        for which, (value, sent, wait) in list(self.pending.items()):
+            if current[which] == value:
+                wait -= 1
+            if wait < 0 or now - sent > self.timeout:
+                del self.pending[which]
+            else:
+                self.pending[which] = (value, sent, wait)
+        if self.pending or now - self.last_sent < self.min_interval:
+            return []
+
+        dc, ac, clipped = self.measure(pkt)
+        level = dc + ac / 2
+        changes = {}
+        starved = 0
+        leds = [
+            (pkt.fmt.index(name), which)
+            for name, which in LEDChannels
+            if name in pkt.fmt.channels
+        ]
+        for c, which in leds:
+            pa = current[which]
+            if clipped[c] > self.max_clipped or level[c] > self.high:
+                if pa <= MinPA:
+                    changes[command.Command.ADCRange] = +1
+                    continue
+                if clipped[c] > self.max_clipped:
+                    new = pa // 2
+                else:
+                    new = int(pa * max(self.target / level[c], 0.5))
+            elif level[c] < self.low:
+                if pa >= MaxPA:
+                    starved += 1
+                    continue
+                new = int(np.ceil(pa * min(self.target / max(level[c], 1e-6), 2.0)))
+            else:
+                continue
+            new = min(max(new, MinPA), MaxPA)
+            if new != pa:
+                changes[which] = new
+        if leds and starved == len(leds):
+            changes[command.Command.ADCRange] = -1
+
+        # A range change alters every level, so do it on its own.
+        step = changes.get(command.Command.ADCRange)
+        if step is not None:
+            i = ADCRanges.index(pkt.adc_range) + step
+            changes = {}
+            if 0 <= i < len(ADCRanges):
+                changes[command.Command.ADCRange] = ADCRanges[i]
+
+        cmds = []
+        for which, value in changes.items():
+            if which == command.Command.ADCRange:
+                payload = command.encode_ADCRange(value)
+            else:
+                payload = value
+            self.log.info(
+                f"{which.name}: {current[which]} -> {value} (DC {dc.round(3)}, AC {ac.round(3)}, clipped {clipped})"
+            )
+            cmds.append(command.make_command(which, payload))
+            self.pending[which] = (value, now, self.settle)
+            self.last_sent = now
+        return cmds
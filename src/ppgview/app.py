@@ -0,0 +1,790 @@
+from queue import Empty
+
+from tornado.ioloop import IOLoop
+from bokeh.server.server import Server
+from bokeh.application import Application
+from bokeh.application.handlers.function import FunctionHandler
+from bokeh.plotting import figure, ColumnDataSource
+from bokeh.layouts import column, row, gridplot
+from bokeh.models import (
+    Select,
+    Slider,
+    Button,
+    Toggle,
+    TextInput,
+    Div,
+    CustomJSTickFormatter,
+    LinearColorMapper,
+)
+from multiprocess import Event, Process, Queue
+
+import logging
+import datetime as dt
+
+import numpy as np
+
+from ppgview import command, ingest, packet, query
+from ppgview.beats import BeatAverager
+from ppgview.capture import RetentionPolicy
+from ppgview.events import EventStore
+from ppgview.ring import SampleRing
+from ppgview.spectrum import StreamingSTFT
+
+
+# Plot titles and colours for known channel names.
+ChannelTitles = {"red": "Red", "ir": "Infrared", "green": "Green"}
+ChannelColors = {"red": "red", "ir": "darkred", "green": "green"}
+
+# Time axis labels in local time: sample times are ms since the epoch, which
+# Bokeh's datetime formatters would show as UTC.
+LocalTimeTicks = """
+const t = new Date(tick);
+const pad = (n, w = 2) => String(n).padStart(w, "0");
+const ms = t.getMilliseconds();
+return `${pad(t.getHours())}:${pad(t.getMinutes())}:${pad(t.getSeconds())}` +
+    (ms ? `.${pad(ms, 3)}` : "");
+"""
+
+# Span colours of the event types.
+EventColors = {
+    "mark": "royalblue",
+    "config": "darkorange",
+    "pid_gap": "gray",
+    "reconnect": "black",
+    "clipping": "crimson",
+}
+
+
+class BokehApp:
+    MaxRate = 1000  # Hz the sample ring is sized for (the device goes to 3200)
+
+    rollover = 300
+    clear_plot = False
+
+    last_collection_mode = command.encode_CollectionMode(3000, 30)
+
+    read_index = 0
+    sps = 100
+
+    # Analysis panels: how far the spectrum and beat template may fall
+    # behind before skipping ahead, the time step treated as a gap,
+    # spectrogram image tiles kept in the browser and their colour range.
+    analysis_backlog = 60  # seconds
+    analysis_gap = 1000  # ms
+    spectrogram_tiles = 600
+    spectrum_range = 60  # dB
+    syncing_controls = False
+
+    def __init__(self, replay=None, fmt=packet.DefaultFormat, retention=None):
+        # Acquisition and parsing run in their own process and hand samples
+        # over through shared memory, so they don't compete with Bokeh for
+        # the GIL. Start it before the IOLoop exists so nothing is forked
+        # from under a running event loop.
+        self.fmt = fmt
+        self.retention = RetentionPolicy() if retention is None else retention
+        self.capture_status = None
+        self.ring = SampleRing(
+            self.retention.ring_capacity(self.MaxRate), len(fmt), writable=False
+        )
+        self.outgoing = Queue()
+        self.control = Queue()
+        self.event_queue = Queue()
+        self.events = EventStore()
+        self.jumped_to = None
+        self.agc_enabled = Event()
+        self.replay = replay
+        self.ingest = Process(
+            target=ingest.run,
+            args=(
+                self.ring.name,
+                self.ring.capacity,
+                self.fmt,
+                self.outgoing,
+                self.control,
+                self.event_queue,
+                self.agc_enabled,
+                self.replay,
+                self.retention,
+            ),
+            daemon=True,
+        )
+        self.ingest.start()
+
+        io_loop = IOLoop.current()
+        store = dict(ring=self.ring, fmt=self.fmt, events=self.events)
+        server = Server(
+            applications={"/myapp": Application(FunctionHandler(self.make_document))},
+            io_loop=io_loop,
+            port=5001,
+            extra_patterns=[
+                (r"/api/info", query.InfoHandler, store),
+                (r"/api/samples", query.SamplesHandler, store),
+                (r"/api/events", query.EventsHandler, store),
+            ],
+        )
+        server.start()
+        server.show("/myapp")
+
+        try:
+            io_loop.start()
+        except KeyboardInterrupt:
+            print("Keyboard interrupt, stopping.")
+            io_loop.stop()
+        finally:
+            self.ingest.terminate()
+            self.ingest.join()
+            self.ring.close()
+            self.events.close()
+
+    @property
+    def write_index(self):
+        return self.ring.write_index
+
+    def queue_command(self, cmd):
+        # Controls synced from a device header must not be echoed back to it.
+        if not self.syncing_controls:
+            self.outgoing.put(cmd)
+
+    def change_agc(self, attr, old, new):
+        log = logging.getLogger("update")
+        log.info(f"Automatic LED control {'enabled' if new else 'disabled'}.")
+        if new:
+            self.agc_enabled.set()
+        else:
+            self.agc_enabled.clear()
+
+    def change_adc_range(self, attr, old, new):
+        log = logging.getLogger("update")
+        log.info(f"ADC range changed from {old} to {new}.")
+        self.queue_command(
+            command.make_command(
+                command.Command.ADCRange, command.encode_ADCRange(int(new))
+            )
+        )
+
+    def change_sample_rate(self, attr, old, new):
+        log = logging.getLogger("update")
+        log.info(f"Sample rate changed from {old} to {new}.")
+        self.queue_command(
+            command.make_command(
+                command.Command.SampleRate, command.encode_SampleRate(int(new))
+            )
+        )
+
+    def change_pulse_width(self, attr, old, new):
+        log = logging.getLogger("update")
+        log.info(f"Pulse width changed from {old} to {new}.")
+        self.queue_command(
+            command.make_command(
+                command.Command.PulseWidth,
+                command.encode_PulseWidth(int(new.split("/")[0])),
+            )
+        )
+
+    def change_sample_avg(self, attr, old, new):
+        log = logging.getLogger("update")
+        log.info(f"Sample average changed from {old} to {new}.")
+        self.queue_command(
+            command.make_command(
+                command.Command.SampleAvg, command.encode_SampleAvg(int(new))
+            )
+        )
+
+    def change_pa_red(self, attr, old, new):
+        log = logging.getLogger("update")
+        log.info(f"PA Red changed from {old} to {new}.")
+        self.queue_command(
+            command.make_command(command.Command.RedLEDPA, int(new * 255.0 / 51.0))
+        )
+
+    def change_pa_ir(self, attr, old, new):
+        log = logging.getLogger("update")
+        log.info(f"PA IR changed from {old} to {new}.")
+        self.queue_command(
+            command.make_command(command.Command.IRLEDPA, int(new * 255.0 / 51.0))
+        )
+
+    def change_collection_period(self, attr, old, new):
+        log = logging.getLogger("update")
+        log.info(f"Collection period changed from {old} to {new}.")
+        _, st = command.decode_CollectionMode(self.last_collection_mode)
+        self.last_collection_mode = command.encode_CollectionMode(int(new), st)
+        self.queue_command(
+            command.make_command(
+                command.Command.CollectionMode, self.last_collection_mode
+            )
+        )
+
+    def change_startup_timeout(self, attr, old, new):
+        log = logging.getLogger("update")
+        log.info(f"Startup timeout changed from {old} to {new}.")
+        cp, _ = command.decode_CollectionMode(self.last_collection_mode)
+        self.last_collection_mode = command.encode_CollectionMode(cp, int(new))
+        self.queue_command(
+            command.make_command(
+                command.Command.CollectionMode, self.last_collection_mode
+            )
+        )
+
+    def send_reboot(self):
+        log = logging.getLogger("update")
+        log.info(f"Sending reboot command.")
+        self.queue_command(command.make_command(command.Command.Reboot, 1))
+
+    def change_rollover(self, attr, old, new):
+        log = logging.getLogger("update")
+        log.info(f"Rollover changed from {old} to {new}.")
+        self.rollover = int(new)
+
+    def change_replay_speed(self, attr, old, new):
+        log = logging.getLogger("update")
+        log.info(f"Replay speed changed from {old} to {new}.")
+        self.replay.speed.value = 0.0 if new == "max" else float(new.rstrip("x"))
+
+    def change_replay_position(self, attr, old, new):
+        log = logging.getLogger("update")
+        log.info(f"Seeking replay to {new:.1f}%.")
+        self.replay.seek.value = new / 100.0
+        self.jumped_to = None
+        self.clear_plot = True
+
+    def jump_to_event(self, forward):
+        # Seek the replay to the next or previous event, counting from the
+        # last one jumped to as well as from where the replay is.
+        wi = self.ring.write_index
+        now = float(self.ring.times(wi - 1, wi)[0]) if wi else None
+        times = [t for t in (now, self.jumped_to) if t is not None]
+        if forward:
+            event = self.events.next(max(times, default=-np.inf))
+        else:
+            event = self.events.previous(min(times, default=np.inf))
+        if event is None:
+            return
+        log = logging.getLogger("update")
+        log.info(f"Jumping to {event.type} event at {event.start:.0f} ms.")
+        self.jumped_to = event.start
+        self.replay.seek_time.value = event.start
+        self.clear_plot = True
+
+    def drain_events(self):
+        # Automatic events and session changes from the ingest process.
+        try:
+            while True:
+                kind, value = self.event_queue.get_nowait()
+                if kind == "session":
+                    self.events.open(value)
+                elif kind == "retention":
+                    self.capture_status = value
+                else:
+                    self.events.add(**value)
+        except Empty:
+            pass
+
+    def retention_text(self):
+        # Where each part of the session is: memory, disk or gone.
+        def clock(ms):
+            return dt.datetime.fromtimestamp(ms / 1000.0).strftime("%H:%M:%S")
+
+        lines = []
+        wi = self.ring.write_index
+        start = self.ring.oldest(wi)
+        if start < wi:
+            t0 = float(self.ring.times(start, start + 1)[0])
+            t1 = float(self.ring.times(wi - 1, wi)[0])
+            lines.append(
+                f"Hot (memory): {clock(t0)} to {clock(t1)}, "
+                f"{(t1 - t0) / 60000:.0f} of "
+                f"{self.ring.capacity / self.sps / 60:.0f} min at this rate"
+            )
+        status = self.capture_status
+        if status is not None and status.get("error"):
+            lines.append(f"<b>Capture failed:</b> {status['error']}")
+        if status is not None and status.get("warm_start") is not None:
+            lines.append(
+                f"Warm (disk): from {clock(status['warm_start'])}, "
+                f"{status['warm_segments']} segments, {status['warm_bytes'] / 1e6:.1f} MB"
+            )
+            if status["other_segments"]:
+                lines.append(
+                    f"Earlier captures: {status['other_segments']} segments, "
+                    f"{status['other_bytes'] / 1e6:.1f} MB"
+                )
+            if status["evicted_segments"]:
+                lines.append(
+                    f"Evicted: {status['evicted_segments']} segments, "
+                    f"{status['evicted_bytes'] / 1e6:.1f} MB"
+                )
+        return "<br>".join(lines)
+
+    def add_mark(self, label):
+        # Operator mark at the newest sample.
+        wi = self.ring.write_index
+        if wi == 0:
+            return
+        t = float(self.ring.times(wi - 1, wi)[0])
+        label = label.strip() or "mark"
+        log = logging.getLogger("update")
+        log.info(f"Marking event: {label}.")
+        self.events.add("mark", t, label=label)
+
+    def clear_plot(self):
+        log = logging.getLogger("update")
+        log.info(f"Clearing plot.")
+        self.clear_plot = True
+
+    def make_document(self, doc):
+        # Data plots.
+        channels = self.fmt.channels
+
+        def empty_data():
+            data = {"time": np.empty(0, dtype="datetime64[ms]")}
+            data.update((name, np.empty(0, np.float64)) for name in channels)
+            return data
+
+        source = ColumnDataSource(empty_data())
+
+        def empty_events():
+            return {
+                k: np.empty(0, np.float64) if k in ("start", "end") else []
+                for k in ("start", "end", "type", "label", "color")
+            }
+
+        event_source = ColumnDataSource(empty_events())
+
+        # One plot row per channel, all on the same time axis.
+        figs = []
+        for name in channels:
+            fig = figure(
+                title=f"{ChannelTitles.get(name, name)} PPG Waveforms",
+                sizing_mode="stretch_both",
+                x_axis_label="Time (s)",
+                x_axis_type="datetime",
+                y_axis_label="Current (µA)",
+            )
+            if figs:
+                fig.x_range = figs[0].x_range
+            fig.vstrip(
+                source=event_source,
+                x0="start",
+                x1="end",
+                fill_color="color",
+                fill_alpha=0.15,
+                line_color="color",
+                line_alpha=0.6,
+            )
+            fig.line(source=source, x="time", y=name, color="blue")
+            fig.xaxis.formatter = CustomJSTickFormatter(code=LocalTimeTicks)
+            figs.append(fig)
+
+        # Spectral panel. Each update streams one image tile holding only the
+        # spectrogram columns computed since the last one.
+        spec_source = ColumnDataSource(
+            {"image": [], "x": [], "y": [], "dw": [], "dh": []}
+        )
+        psd_source = ColumnDataSource(
+            {"freq": np.empty(0, np.float64), "psd": np.empty(0, np.float64)}
+        )
+        spec_mapper = LinearColorMapper(palette="Viridis256", low=-60, high=0)
+
+        fig_spec = figure(
+            title="Spectrogram",
+            sizing_mode="stretch_both",
+            x_axis_label="Time (s)",
+            x_axis_type="datetime",
+            y_axis_label="Frequency (Hz)",
+        )
+        fig_spec.image(
+            source=spec_source,
+            image="image",
+            x="x",
+            y="y",
+            dw="dw",
+            dh="dh",
+            color_mapper=spec_mapper,
+        )
+        fig_spec.xaxis.formatter = CustomJSTickFormatter(code=LocalTimeTicks)
+
+        fig_psd = figure(
+            title="Power Spectral Density",
+            sizing_mode="stretch_both",
+            x_axis_label="Frequency (Hz)",
+            y_axis_label="PSD (µA²/Hz)",
+            y_axis_type="log",
+        )
+        fig_psd.line(source=psd_source, x="freq", y="psd", color="blue")
+
+        # Beat template: ensemble mean and ±1 SD of each channel, replaced
+        # whenever a beat is added.
+        def empty_template():
+            data = {"t": np.empty(0, np.float64)}
+            for name in channels:
+                for column in (name, f"{name}_lo", f"{name}_hi"):
+                    data[column] = np.empty(0, np.float64)
+            return data
+
+        template_source = ColumnDataSource(empty_template())
+        fig_beat = figure(
+            title="Beat Template",
+            sizing_mode="stretch_both",
+            x_axis_label="Time from foot (ms)",
+            y_axis_label="Normalized amplitude",
+        )
+        for name in channels:
+            color = ChannelColors.get(name, "gray")
+            fig_beat.varea(
+                source=template_source,
+                x="t",
+                y1=f"{name}_lo",
+                y2=f"{name}_hi",
+                color=color,
+                alpha=0.2,
+            )
+            fig_beat.line(
+                source=template_source,
+                x="t",
+                y=name,
+                color=color,
+                legend_label=ChannelTitles.get(name, name),
+            )
+
+        plot_layout = column(
+            gridplot([[fig] for fig in figs], sizing_mode="stretch_both"),
+            row(fig_spec, fig_psd, fig_beat, sizing_mode="stretch_both"),
+            sizing_mode="stretch_both",
+        )
+
+        # Controls.
+        sel_adc_range = Select(
+            title="ADC Range (nA):",
+            value="4096",
+            options=["2048", "4096", "8192", "16384"],
+            width_policy="max",
+        )
+        sel_adc_range.on_change("value", self.change_adc_range)
+
+        sel_sample_rate = Select(
+            title="Sample Rate (Hz):",
+            value="100",
+            options=["50", "100", "200", "400", "800", "1000", "1600", "3200"],
+            width_policy="max",
+        )
+        sel_sample_rate.on_change("value", self.change_sample_rate)
+
+        sel_pulse_width = Select(
+            title="Pulse Width (µs / ADC bits):",
+            value="118 / 16",
+            options=["69 / 15", "118 / 16", "215 / 17", "411 / 18"],
+            width_policy="max",
+        )
+        sel_pulse_width.on_change("value", self.change_pulse_width)
+
+        sel_sample_avg = Select(
+            title="Sample Average:",
+            value="1",
+            options=["1", "2", "4", "8", "16", "32"],
+            width_policy="max",
+        )
+        sel_sample_avg.on_change("value", self.change_sample_avg)
+
+        sld_pa_red = Slider(
+            title="Red LED Current (mA):", value=0, start=0, end=51, step=0.2
+        )
+        sld_pa_red.on_change("value", self.change_pa_red)
+
+        sld_pa_ir = Slider(
+            title="IR LED Current (mA):", value=0, start=0, end=51, step=0.2
+        )
+        sld_pa_ir.on_change("value", self.change_pa_ir)
+
+        tgl_agc = Toggle(
+            label="Automatic LED Control",
+            active=self.agc_enabled.is_set(),
+            width_policy="max",
+        )
+        tgl_agc.on_change("active", self.change_agc)
+
+        sld_collection_period = Slider(
+            title="Collection period (ms):", value=0, start=0, end=7500, step=500
+        )
+        sld_collection_period.on_change("value", self.change_collection_period)
+
+        sld_startup_timeout = Slider(
+            title="Startup timeout (s):", value=0, start=0, end=150, step=10
+        )
+        sld_startup_timeout.on_change("value", self.change_startup_timeout)
+
+        btn_reboot = Button(
+            label="Flash Config and Reboot", button_type="success", width_policy="max"
+        )
+        btn_reboot.on_click(self.send_reboot)
+
+        sld_rollover = Slider(
+            title="Rollover (samples):", value=500, start=100, end=2000, step=25
+        )
+        sld_rollover.on_change("value", self.change_rollover)
+
+        btn_clear_plot = Button(
+            label="Clear Plot", button_type="danger", width_policy="max"
+        )
+        btn_clear_plot.on_click(self.clear_plot)
+
+        sel_spectrum_channel = Select(
+            title="Spectrum channel:",
+            value="ir" if "ir" in channels else channels[0],
+            options=[(name, ChannelTitles.get(name, name)) for name in channels],
+            width_policy="max",
+        )
+
+        txt_mark = TextInput(
+            title="Event label:",
+            placeholder="motion, posture change...",
+            width_policy="max",
+        )
+        btn_mark = Button(label="Mark Event", button_type="primary", width_policy="max")
+        btn_mark.on_click(lambda: self.add_mark(txt_mark.value))
+
+        div_retention = Div(text="", width_policy="max")
+
+        replay_controls = []
+        if self.replay is not None:
+            speed = self.replay.speed.value
+            sel_replay_speed = Select(
+                title="Replay speed:",
+                value="max" if speed <= 0 else f"{speed:g}x",
+                options=["0.5x", "1x", "2x", "5x", "10x", "max"],
+                width_policy="max",
+            )
+            sel_replay_speed.on_change("value", self.change_replay_speed)
+
+            # Only react to the user letting go of the slider, not to the
+            # position updates pushed from here.
+            sld_replay_position = Slider(
+                title="Replay position (%):", value=0, start=0, end=100, step=0.1
+            )
+            sld_replay_position.on_change(
+                "value_throttled", self.change_replay_position
+            )
+            btn_previous_event = Button(label="◀ Previous event", width_policy="max")
+            btn_previous_event.on_click(lambda: self.jump_to_event(False))
+            btn_next_event = Button(label="Next event ▶", width_policy="max")
+            btn_next_event.on_click(lambda: self.jump_to_event(True))
+            replay_controls = [
+                sel_replay_speed,
+                sld_replay_position,
+                row(btn_previous_event, btn_next_event, sizing_mode="stretch_width"),
+            ]
+
+        controls_layout = column(
+            *replay_controls,
+            sel_adc_range,
+            sel_sample_rate,
+            sel_pulse_width,
+            sel_sample_avg,
+            sld_pa_ir,
+            sld_pa_red,
+            tgl_agc,
+            sld_collection_period,
+            sld_startup_timeout,
+            btn_reboot,
+            sld_rollover,
+            btn_clear_plot,
+            sel_spectrum_channel,
+            txt_mark,
+            btn_mark,
+            div_retention,
+            width_policy="min",
+        )
+
+        layout = row(plot_layout, controls_layout, sizing_mode="stretch_both")
+
+        # Per-document analysis state: the ring index of the next sample to
+        # analyse and the time of the last one, the spectrum transform and
+        # the ring index of its first sample, and the beat averager.
+        analysis_index = 0
+        analysis_last_time = None
+        stft = None
+        spec_base = 0
+        beats = None
+        detect = channels.index("ir") if "ir" in channels else 0
+
+        def restart_spectrum(index):
+            nonlocal stft, spec_base
+            stft = StreamingSTFT(self.sps)
+            spec_base = index
+
+        def restart_analysis(index):
+            # The stream jumped (or we skipped ahead): start afresh at index.
+            nonlocal analysis_index, analysis_last_time
+            analysis_index = index
+            analysis_last_time = None
+            restart_spectrum(index)
+            beats.reset()
+
+        def update_analysis(wi):
+            nonlocal analysis_index, analysis_last_time, beats
+            if stft is None or stft.fs != self.sps:
+                beats = BeatAverager(self.sps, len(channels), detect=detect)
+                restart_analysis(wi)
+            # Too far behind (e.g. a fast replay): skip ahead rather than
+            # analyse samples that would scroll straight out of view.
+            backlog = int(self.analysis_backlog * self.sps)
+            if wi - analysis_index > backlog:
+                restart_analysis(wi - backlog)
+            if analysis_index >= wi:
+                return
+
+            start, time, values = self.ring.read(analysis_index, wi)
+            if start != analysis_index:
+                restart_analysis(start)
+            analysis_index = wi
+            if not len(time):
+                return
+
+            # Restart after reconnects and seeks, where time jumps.
+            time_ms = time.view(np.int64)
+            gaps = np.flatnonzero(np.diff(time_ms) > self.analysis_gap)
+            if (
+                analysis_last_time is not None
+                and abs(time_ms[0] - analysis_last_time) > self.analysis_gap
+            ):
+                restart_analysis(start)
+            if len(gaps):
+                cut = int(gaps[-1]) + 1
+                restart_analysis(start + cut)
+                start, time_ms, values = start + cut, time_ms[cut:], values[:, cut:]
+            analysis_index = wi
+            analysis_last_time = int(time_ms[-1])
+
+            update_spectrum(start, time_ms, values)
+            if beats.update(values):
+                update_template()
+
+        def update_spectrum(start, time_ms, values):
+            # start is the ring index of the first sample in values.
+            x = values[channels.index(sel_spectrum_channel.value)]
+            index, columns = stft.update(x)
+            if not len(columns):
+                return
+
+            # Time of the first new window's centre, from the slice just read.
+            period = 1000.0 / stft.fs
+            first = spec_base + index + stft.nfft / 2
+            x0 = time_ms[0] + (first - start) * period
+            db = 10 * np.log10(columns.T + 1e-20)
+            spec_source.stream(
+                dict(
+                    image=[db.astype(np.float32)],
+                    x=[x0 - stft.hop * period / 2],
+                    y=[0.0],
+                    dw=[len(columns) * stft.hop * period],
+                    dh=[stft.fs / 2],
+                ),
+                rollover=self.spectrogram_tiles,
+            )
+            psd_source.data = dict(freq=stft.freqs[1:], psd=stft.psd[1:])
+            top = 10 * np.log10(stft.psd[1:].max() + 1e-20)
+            if abs(top - spec_mapper.high) > 3:
+                spec_mapper.high = top
+                spec_mapper.low = top - self.spectrum_range
+
+        def update_template():
+            data = {"t": beats.phase * beats.duration}
+            std = beats.std
+            for c, name in enumerate(channels):
+                data[name] = beats.mean[c]
+                data[f"{name}_lo"] = beats.mean[c] - std[c]
+                data[f"{name}_hi"] = beats.mean[c] + std[c]
+            template_source.data = data
+            fig_beat.title.text = (
+                f"Beat Template ({beats.beats} beats, {beats.heart_rate:.0f} bpm, "
+                f"rise {beats.rise_time:.0f} ms, notch {beats.notch:.0%})"
+            )
+
+        def clear_spectrum():
+            if stft is not None:
+                restart_spectrum(analysis_index)
+            spec_source.data = {"image": [], "x": [], "y": [], "dw": [], "dh": []}
+
+        def clear_analysis():
+            nonlocal stft
+            stft = None
+            spec_source.data = {"image": [], "x": [], "y": [], "dw": [], "dh": []}
+            template_source.data = empty_template()
+            fig_beat.title.text = "Beat Template"
+
+        sel_spectrum_channel.on_change("value", lambda attr, old, new: clear_spectrum())
+
+        # Events overlapping the plotted window, redrawn only when they change.
+        shown_events = None
+
+        def update_events(wi):
+            nonlocal shown_events
+            start = max(wi - self.rollover, self.ring.oldest(wi))
+            found = []
+            if start < wi:
+                t0 = float(self.ring.times(start, start + 1)[0])
+                t1 = float(self.ring.times(wi - 1, wi)[0])
+                found = self.events.query(t0, t1)
+            key = [(e.type, e.start, e.end) for e in found]
+            if key == shown_events:
+                return
+            shown_events = key
+            event_source.data = dict(
+                start=np.array([e.start for e in found], dtype=np.float64),
+                end=np.array([e.end for e in found], dtype=np.float64),
+                type=[e.type for e in found],
+                label=[e.label for e in found],
+                color=[EventColors.get(e.type, "purple") for e in found],
+            )
+
+        def update():
+            # Clear the plot first?
+            if self.clear_plot:
+                self.clear_plot = False
+                source.data = empty_data()
+                clear_analysis()
+
+            # Update plot if there's new data. Anything older than the
+            # rollover would be dropped by the browser anyway.
+            wi = self.ring.write_index
+            self.read_index = max(self.read_index, wi - self.rollover)
+            if self.read_index < wi:
+                _, time, values = self.ring.read(self.read_index, wi)
+                source.stream(
+                    dict(time=time, **dict(zip(channels, values))),
+                    rollover=self.rollover,
+                )
+                self.read_index = wi
+            update_analysis(wi)
+            self.drain_events()
+            update_events(wi)
+            text = self.retention_text()
+            if text != div_retention.text:
+                div_retention.text = text
+
+            # Do we need to update the controls?
+            try:
+                pkt = self.control.get_nowait()
+            except Empty:
+                pkt = None
+            if pkt is not None:
+                self.syncing_controls = True
+                try:
+                    sel_adc_range.value = str(pkt["adc_range"])
+                    sel_sample_rate.value = str(pkt["sample_rate"])
+                    sel_pulse_width.value = f"{pkt['pulse_width']} / {pkt['adc_bits']}"
+                    sel_sample_avg.value = str(pkt["sample_avg"])
+                    sld_pa_red.value = pkt["red_pa"] * 51.0 / 255.0
+                    sld_pa_ir.value = pkt["ir_pa"] * 51.0 / 255.0
+                    sld_collection_period.value = pkt["collection_period"]
+                    sld_startup_timeout.value = pkt["startup_timeout"]
+                    self.sps = pkt["sample_rate"] / pkt["sample_avg"]
+                finally:
+                    self.syncing_controls = False
+
+            if self.replay is not None:
+                sld_replay_position.value = 100.0 * self.replay.position.value
+
+        doc.add_root(layout)
+        doc.add_periodic_callback(update, 50)
+        doc.title = "PPGView" if self.replay is None else "PPGView (replay)"
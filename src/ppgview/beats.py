@@ -0,0 +1,219 @@
+import numpy as np
+
+
+class BeatAverager:
+    """
+    Online beat segmentation and ensemble averaging.
+
+    Beats are detected on one channel (detect) from the upstroke: the
+    smoothed slope crossing a fraction of the typical peak slope starts a
+    beat, and its foot is the preceding minimum. Each beat, foot to foot, is
+    resampled to `length` points for every channel at once, normalized to
+    the [0, 1] foot-to-peak range and folded into an exponentially weighted
+    mean and variance. Once the template has settled, beats are weighted by
+    their squared correlation with it, so artifacts barely move it, and beats
+    correlating below min_corr are rejected.
+
+    Only the samples since the last foot are kept, so the cost per update is
+    proportional to the new samples and every beat is processed once.
+    Morphology features are computed from the detect channel's template:
+    rise time (foot to systolic peak) and the dicrotic notch position (the
+    first local minimum after the peak, or the steepest change of slope if
+    the notch does not dip).
+    """
+
+    def __init__(
+        self,
+        fs,
+        channels=2,
+        detect=0,
+        length=100,
+        forget=0.05,
+        threshold=0.4,
+        min_beat=0.3,
+        max_beat=2.0,
+        warmup=5,
+        min_corr=0.5,
+    ):
+        self.fs = fs
+        self.detect = detect
+        self.length = length
+        self.forget = forget
+        self.threshold = threshold
+        self.min_beat = int(min_beat * fs)
+        self.max_beat = int(max_beat * fs)
+        self.warmup = warmup
+        self.min_corr = min_corr
+
+        # Slope smoothing half-width and how far back a foot may be found.
+        self.half = max(int(0.025 * fs), 1)
+        self.lookback = max(int(0.3 * fs), 1)
+
+        # Samples from abs index self.offset on.
+        self.buf = np.empty((channels, 0))
+        self.offset = 0
+        self.scanned = 0
+        self.last_onset = 0
+        self.last_foot = None
+        self.peak_slope = None
+
+        self.beats = 0
+        self.rejected = 0
+        self.weight = 0.0
+        self.mean = np.zeros((channels, length))
+        self.m2 = np.zeros((channels, length))
+        self.duration = 0.0
+        self.rise_time = float("nan")
+        self.notch = float("nan")
+        self.notch_time = float("nan")
+
+        # Template points as a fraction of the beat.
+        self.phase = np.linspace(0.0, 1.0, length)
+
+    def reset(self):
+        # The stream jumped: drop the partial beat but keep the template.
+        self.offset += self.buf.shape[1]
+        self.buf = self.buf[:, :0]
+        self.scanned = self.last_onset = self.offset
+        self.last_foot = None
+        self.peak_slope = None
+
+    @property
+    def std(self):
+        return np.sqrt(self.m2 / max(self.weight, 1e-12))
+
+    @property
+    def heart_rate(self):
+        return 60000.0 / self.duration if self.duration else float("nan")
+
+    def update(self, x):
+        """
+        Feed new samples, shape (channels, n). Returns the number of beats
+        added to the template.
+        """
+        self.buf = np.concatenate((self.buf, x), axis=1)
+        end = self.offset + self.buf.shape[1]
+        y = self.buf[self.detect]
+
+        # Smoothed slope, only where the whole window is available.
+        h = self.half
+        # Start one back so a crossing between two updates isn't missed.
+        lo = max(self.scanned - 1, self.offset + h + 1)
+        hi = end - h
+        added = 0
+        if hi > lo:
+            a, b = lo - self.offset, hi - self.offset
+            slope = (y[a + h : b + h] - y[a - h - 1 : b - h - 1]) / (2 * h + 1)
+            if self.peak_slope is None:
+                if end - self.offset < self.max_beat:
+                    return 0
+                self.peak_slope = float(np.percentile(slope, 99))
+                self.last_onset = lo
+            # Onsets in order. If none comes within 2 * max_beat of the last,
+            # the pulse may have got weaker: halve the threshold from that
+            # point on and look again. Checked per onset, so one long chunk
+            # behaves like many short ones.
+            pos = lo
+            while pos < hi:
+                thr = self.threshold * self.peak_slope
+                s = slope[pos - lo :]
+                rising = np.flatnonzero((s[:-1] < thr) & (s[1:] >= thr)) + 1 + pos
+                deadline = self.last_onset + 2 * self.max_beat
+                pos = hi
+                for i in rising.tolist():
+                    if i > deadline:
+                        break
+                    if i - self.last_onset < self.min_beat:
+                        continue
+                    self.last_onset = i
+                    start = max(i - self.lookback, self.offset)
+                    foot = start + int(
+                        np.argmin(y[start - self.offset : i - self.offset])
+                    )
+                    if self.last_foot is not None and foot > self.last_foot:
+                        added += self._beat(self.last_foot, foot)
+                    self.last_foot = foot
+                    deadline = self.last_onset + 2 * self.max_beat
+                if deadline < hi:
+                    self.peak_slope *= 0.5
+                    self.last_onset = pos = max(deadline, lo)
+            self.scanned = hi
+
+        # Keep only what the next beat can still need.
+        keep = max(self.scanned - self.max_beat - self.lookback, self.offset)
+        if self.last_foot is not None:
+            if self.last_foot < keep:
+                self.last_foot = None
+            else:
+                keep = self.last_foot
+        self.buf = self.buf[:, keep - self.offset :]
+        self.offset = keep
+        return added
+
+    def _beat(self, start, end):
+        n = end - start
+        if n < self.min_beat or n > self.max_beat:
+            return 0
+        seg = self.buf[:, start - self.offset : end - self.offset + 1]
+
+        # Resample every channel to the template length in one go.
+        pos = self.phase * n
+        i0 = np.minimum(pos.astype(np.intp), n - 1)
+        frac = pos - i0
+        beat = seg[:, i0] * (1.0 - frac) + seg[:, i0 + 1] * frac
+
+        low = beat.min(axis=1, keepdims=True)
+        amp = beat.max(axis=1, keepdims=True) - low
+        if not np.all(amp > 0):
+            return 0
+        beat = (beat - low) / amp
+
+        # Slope of this beat, for the detection threshold.
+        h = self.half
+        y = seg[self.detect]
+        if len(y) > 2 * h + 1:
+            peak = np.max(y[2 * h + 1 :] - y[: -2 * h - 1]) / (2 * h + 1)
+            self.peak_slope += 0.2 * (peak - self.peak_slope)
+
+        w = 1.0
+        if self.beats >= self.warmup:
+            corr = np.corrcoef(beat[self.detect], self.mean[self.detect])[0, 1]
+            if not corr >= self.min_corr:
+                self.rejected += 1
+                return 0
+            w = corr**2
+
+        # Exponentially weighted mean and variance (West's algorithm with
+        # forgetting).
+        decay = 1.0 - self.forget
+        self.weight = decay * self.weight + w
+        delta = beat - self.mean
+        self.mean += (w / self.weight) * delta
+        self.m2 = decay * self.m2 + w * delta * (beat - self.mean)
+        ms = n * 1000.0 / self.fs
+        self.duration += (w / self.weight) * (ms - self.duration)
+        self.beats += 1
+        self._features()
+        return 1
+
+    def _features(self):
+        m = self.mean[self.detect]
+        L = self.length
+        peak = int(np.argmax(m))
+        self.rise_time = peak / (L - 1) * self.duration
+
+        d = np.diff(m[peak:])
+        limit = int(0.85 * L) - peak
+        minima = np.flatnonzero((d[:-1] < 0) & (d[1:] >= 0))
+        minima = minima[minima < limit]
+        if len(minima):
+            notch = peak + int(minima[0]) + 1
+        elif limit > 2:
+            notch = peak + 1 + int(np.argmax(np.diff(d[:limit])))
+        else:
+            notch = None
+        if notch is None:
+            self.notch = self.notch_time = float("nan")
+        else:
+            self.notch = notch / (L - 1)
+            self.notch_time = self.notch * self.duration
@@ -9,21 +9,49 @@ from adafruit_ble.advertising.standard import Advertisement
 from ppgview.sensor import TEGSenseSensor
 
 
+# Delays (s) before each attempt to reconnect directly to the last sensor,
+# before falling back to a full scan.
+ReconnectDelays = (0.0, 0.05, 0.1, 0.25, 0.5, 1.0, 2.0)
+
+
 class TEGSenseBLE:
-    def __init__(self):
+    poll_interval = 0.01  # s
+    reconnect_timeout = 1.0  # s
+
+    def __init__(self, retention=None):
         self.log = getLogger("TEGSenseBLE")
+        self.retention = retention
+        self.radio = None
         self.sensor = None
         self.data = None
         self.dt = None
+        self.capture_base = None
+        self.discontinuity = False
+        self.seeked = False
+        self.anchors = ()
+
+    @property
+    def connected(self):
+        # A capture session is open (the link itself may be down).
+        return self.sensor is not None
 
     def connect(self):
+        # After a dropout, go straight back to the sensor we know instead of
+        # rescanning, and keep its capture going.
+        if self.sensor is not None:
+            if self.reconnect():
+                return
+            self.log.warning("Could not reconnect directly, rescanning...")
+
         qin = Queue()
         qout = Queue()
         pq = Queue()
 
         # Find sensors.
         self.log.info("Scanning for TEGSense sensor...")
-        ble = BLERadio()
+        if self.radio is None:
+            self.radio = BLERadio()
+        ble = self.radio
         device_adv = None
         for adv in ble.start_scan(Advertisement, timeout=None):
             if adv.complete_name is None:
@@ -42,30 +70,65 @@ class TEGSenseBLE:
 
         device_name = device_adv.complete_name
 
-        self.dt = dt.datetime.now()
+        # Same sensor as before: carry on with its session and capture.
+        if (
+            self.sensor is not None
+            and self.sensor.advertisement.address == device_adv.address
+        ):
+            self.sensor.advertisement = device_adv
+            if self.reconnect(delays=(0.0,)):
+                return
+            raise RuntimeError("Could not connect to tegsense sensor!")
+        if self.sensor is not None:
+            self.disconnect()
+
+        self.dt = dt.datetime.now().astimezone()
         self.dtnow = self.dt.strftime("%Y%m%d_%H%M%S")
         nowstamp = f"tegsense-{self.dtnow}"
+        self.capture_base = nowstamp
         self.log.info(f"Connecting to {device_adv.complete_name}.")
         self.sensor = TEGSenseSensor(
-            device_name, ble, device_adv, qout, qin, pq, nowstamp
+            device_name, ble, device_adv, qout, qin, pq, nowstamp, self.retention
         )
         self.log.info(f"Connecting to device {self.sensor}")
         if self.sensor.connect():
             self.log.info(" - Connected.")
         else:
+            self.sensor.hil.close()
             self.sensor = None
             self.log.error(" - Failed to connect to BLE device.")
             raise RuntimeError("Could not connect to tegsense sensor!")
 
-        self.bi = 0
-        self.bend = 0
+    def reconnect(self, delays=ReconnectDelays):
+        started = time.monotonic()
+        for attempt, delay in enumerate(delays):
+            time.sleep(delay)
+            try:
+                if self.sensor.connect(timeout=self.reconnect_timeout):
+                    self.log.info(
+                        f"Reconnected to {self.sensor} in {(time.monotonic() - started) * 1000:.0f} ms "
+                        f"(attempt {attempt + 1})."
+                    )
+                    # Record the gap in the capture and tell the reader the
+                    # stream is not contiguous.
+                    self.sensor.hil.mark_gap()
+                    self.discontinuity = True
+                    return True
+            except Exception as e:
+                self.log.warning(f"Reconnect attempt {attempt + 1} failed: {e}")
+        return False
 
-    def disconnect(self):
+    def disconnect(self, close=True):
+        """
+        Drop the BLE link. Unless close is set, the sensor and its capture
+        are kept so connect() can resume the session.
+        """
         self.log.info("Disconnecting sensor...")
         if self.sensor is not None:
             self.sensor.disconnect()
-            self.sensor.hil.close()
-            self.sensor = None
+            if close:
+                self.sensor.hil.close()
+                self.sensor = None
         else:
             self.log.warning("Tried to disconnect sensor, but it was not connected!")
 
@@ -73,25 +136,34 @@ class TEGSenseBLE:
         # self.log.info("Waiting for more data...")
         if self.sensor is None:
             raise RuntimeError("Sensor not connected!")
-        disconnected = 0
         while True:
-            # Connected?
+            # Connected? The link going down is final, so hand straight over
+            # to reconnecting rather than waiting for it to come back.
             if not self.sensor.connected:
-                disconnected += 1
-                if disconnected == 1:
-                    self.log.warning(
-                        f"Sensor {self.sensor.name} disconnected. Waiting for more data..."
-                    )
-                if disconnected > 5:
-                    raise RuntimeError("Sensor disconnected!")
-                time.sleep(1)
+                self.log.warning(f"Sensor {self.sensor.name} disconnected.")
+                raise RuntimeError("Sensor disconnected!")
 
             # Collect data.
             data = self.sensor.hil.process_uart()
             if data is not None and len(data) > 0:
                 self.data = data
                 return data
-            time.sleep(0.1)
+            time.sleep(self.poll_interval)
+
+    def pace(self, pkt):
+        # Live data arrives at its own pace.
+        pass
+
+    def mark_time(self, mcu_time, wall=None, rate=1.0):
+        # Index the raw capture by MCU time and record the clock mapping.
+        if self.sensor is not None:
+            self.sensor.hil.mark_time(mcu_time, wall, rate)
+
+    def capture_status(self):
+        # Retention status of the raw capture (RawLogger.status).
+        if self.sensor is not None:
+            return self.sensor.hil.capture_status()
+        return None
 
     def send(self, cmd):
         if self.sensor is None:
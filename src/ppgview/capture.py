@@ -0,0 +1,618 @@
+import os
+import glob
+import mmap
+import time
+import zlib
+import queue
+import struct
+import logging
+import threading
+
+from dataclasses import dataclass
+from typing import Optional
+
+import numpy as np
+
+# Segmented raw capture format.
+#
+# A capture is a series of segment files <base>.NNNN.cap, each covering at
+# most segment_seconds of the session. A segment is a sequence of frames,
+# each independently zlib-compressed:
+#
+#   magic: 4s ("PPGF")
+#   version: uint16
+#   flags: uint16
+#   raw_offset: uint64  (offset of the first byte in the session raw stream)
+#   mcu_time: int64     (MCU time of the first packet seen in the frame, or -1)
+#   raw_len: uint32
+#   comp_len: uint32
+#   crc: uint32         (CRC32 of the raw bytes)
+#   wall: float64       (with FlagClock: wall time, ms since the epoch, of the
+#                        first sample of the packet at mcu_time)
+#   rate: float64       (with FlagClock: that packet's sample period relative
+#                        to nominal)
+#   <compressed data>: byte * comp_len
+#
+# wall and rate record where the live clock model put the packet, so a replay
+# can put the samples at the same times. Version 1 frames never have them.
+#
+# Next to each segment, <base>.NNNN.idx holds one FrameIndex record per frame
+# so a byte offset or MCU time can be located without decompressing. The
+# index is only a cache: frames past its end (e.g. after a crash) are found
+# by scanning the frame headers.
+
+# Capture segments that retention applies to, in the capture's directory.
+CapturePattern = "tegsense-*.in.*.cap"
+
+FrameMagic = b"PPGF"
+FrameVersion = 2
+FrameHeader = struct.Struct("<4sHHQqIII")
+FrameClock = struct.Struct("<dd")
+
+# Frame flags.
+FlagGap = 0x0001  # The stream was interrupted before this frame.
+FlagClock = 0x0002  # The header is followed by wall and rate.
+
+FrameIndex = np.dtype(
+    [
+        ("raw_offset", "<u8"),
+        ("mcu_time", "<i8"),
+        ("file_offset", "<u8"),
+        ("raw_len", "<u4"),
+        ("comp_len", "<u4"),
+        ("flags", "<u4"),
+        ("crc", "<u4"),
+    ]
+)
+
+
+@dataclass
+class RetentionPolicy:
+    """
+    How much of a session to keep. The newest hot_minutes of samples are held
+    in memory: the sample ring is sized for them at max_rate (1000 Hz in the
+    app), so faster rates fill it sooner. The raw captures on disk (this
+    session's and earlier ones' segments in its directory) are trimmed to the
+    newest warm_hours and at most max_disk_bytes, dropping whole segments
+    oldest first. None means no limit. The segment being written is never
+    dropped.
+    """
+
+    hot_minutes: float = 600.0
+    warm_hours: Optional[float] = None
+    max_disk_bytes: Optional[int] = None
+
+    def ring_capacity(self, max_rate):
+        return int(self.hot_minutes * 60 * max_rate)
+
+
+def _header_size(flags):
+    # Bytes before a frame's compressed data (flags may be an array).
+    return FrameHeader.size + FrameClock.size * ((flags & FlagClock) != 0)
+
+
+def _disk_size(segment):
+    # Bytes on disk of a segment and its index.
+    size = 0
+    for path in (segment, index_name(segment)):
+        try:
+            size += os.path.getsize(path)
+        except OSError:
+            pass
+    return size
+
+
+def segment_name(base, seq):
+    return f"{base}.{seq:04d}.cap"
+
+
+def index_name(segment):
+    return segment[: -len(".cap")] + ".idx"
+
+
+class RawLogger:
+    """
+    Writes the raw input stream as a segmented, framed, compressed capture.
+
+    write() only appends to the current frame under a short lock, so the
+    receive path never waits on compression or disk. A frame is sealed when
+    it reaches frame_bytes or frame_seconds and handed to a background thread
+    that compresses it, writes it and its index record, rotates segments
+    every segment_seconds and flushes/fsyncs every sync_interval seconds.
+    Segment files are only created once there is data to put in them.
+
+    With a RetentionPolicy, the same thread deletes the oldest segments once
+    they fall outside it, so eviction never holds up write(). status
+    describes the segments kept and dropped (wall times in ms since the
+    epoch) and is replaced, never modified, so other threads can read it
+    freely.
+
+    If writing fails (e.g. the disk is full), the error is logged and kept
+    in error and status, and from then on data is dropped instead of queued:
+    write() returns False.
+    """
+
+    def __init__(
+        self,
+        base,
+        segment_seconds=15 * 60,
+        frame_bytes=64 * 1024,
+        frame_seconds=1.0,
+        sync_interval=5.0,
+        level=6,
+        retention=None,
+    ):
+        self.log = logging.getLogger("capture")
+        self.base = base
+        self.segment_seconds = segment_seconds
+        self.frame_bytes = frame_bytes
+        self.frame_seconds = frame_seconds
+        self.sync_interval = sync_interval
+        self.level = level
+        self.retention = retention
+        if retention is not None and retention.warm_hours is not None:
+            # Segments are what gets deleted; keep them small next to the
+            # warm window.
+            self.segment_seconds = min(segment_seconds, retention.warm_hours * 900)
+
+        self._lock = threading.Lock()
+        self._frame = bytearray()
+        self._frame_start = None
+        self._frame_time = -1
+        self._frame_clock = None
+        self._flags = 0
+        self._offset = 0
+
+        self.seq = -1
+        self.segment = None
+        self.index = None
+        self.segments = []
+        self._segment_times = []
+        self._segment_start = None
+        self._evicted = 0
+        self._evicted_bytes = 0
+        self.status = None
+        self.error = None
+        self._last_sync = time.monotonic()
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    @property
+    def size(self):
+        # Raw bytes logged so far, including the unsealed frame.
+        with self._lock:
+            return self._offset + len(self._frame)
+
+    def write(self, data):
+        with self._lock:
+            if self.error is not None:
+                return False
+            if not self._frame:
+                self._frame_start = time.monotonic()
+            self._frame += data
+            if len(self._frame) >= self.frame_bytes:
+                self._seal()
+        return True
+
+    def mark_time(self, mcu_time, wall=None, rate=1.0):
+        # Tag the current frame with the first MCU time seen in it and, if
+        # given, the wall time and period ratio the clock gave that packet.
+        with self._lock:
+            if self._frame_time < 0:
+                self._frame_time = mcu_time
+                self._frame_clock = None if wall is None else (wall, rate)
+
+    def mark_gap(self):
+        # The stream was interrupted: start a new frame flagged as a gap.
+        with self._lock:
+            self._seal()
+            self._flags |= FlagGap
+
+    def close(self):
+        with self._lock:
+            self._seal()
+        self._queue.put(None)
+        self._thread.join()
+        try:
+            self._close_segment()
+        except OSError as e:
+            self._fail(e)
+        if not self.segments:
+            self.log.warning(f"No input captured for {self.base}.")
+
+    def _seal(self):
+        # Called with the lock held.
+        if not self._frame:
+            return
+        if self.error is not None:
+            self._frame = bytearray()
+            return
+        self._queue.put(
+            (
+                self._offset,
+                self._frame_time,
+                self._frame_clock,
+                self._flags,
+                self._frame,
+            )
+        )
+        self._offset += len(self._frame)
+        self._frame = bytearray()
+        self._frame_time = -1
+        self._frame_clock = None
+        self._flags = 0
+
+    def _run(self):
+        while True:
+            try:
+                item = self._queue.get(timeout=self.frame_seconds)
+            except queue.Empty:
+                item = False
+            if item is None:
+                return
+            if self.error is not None:
+                continue
+
+            try:
+                self._step(item)
+            except Exception as e:
+                self._fail(e)
+
+    def _step(self, item):
+        if item:
+            self._write_frame(*item)
+        else:
+            # Nothing sealed lately; don't let a quiet stream sit in memory.
+            with self._lock:
+                if (
+                    self._frame
+                    and time.monotonic() - self._frame_start >= self.frame_seconds
+                ):
+                    self._seal()
+
+        if time.monotonic() - self._last_sync >= self.sync_interval:
+            self._sync()
+            self._evict()
+
+    def _fail(self, error):
+        # Stop capturing: drop what is pending and everything after it.
+        self.log.error(f"Capture to {self.base} failed, no longer recording: {error}")
+        with self._lock:
+            self.error = f"{type(error).__name__}: {error}"
+            self._frame = bytearray()
+        self.status = dict(self.status or {}, error=self.error)
+        for f in (self.segment, self.index):
+            if f is not None:
+                try:
+                    f.close()
+                except OSError:
+                    pass
+        self.segment = None
+        self.index = None
+
+    def _write_frame(self, raw_offset, mcu_time, clock, flags, data):
+        now = time.monotonic()
+        if self.segment is None or now - self._segment_start >= self.segment_seconds:
+            self._close_segment()
+            self._open_segment()
+
+        crc = zlib.crc32(data)
+        comp = zlib.compress(data, self.level)
+        if clock is not None:
+            flags |= FlagClock
+        file_offset = self.segment.tell()
+        self.segment.write(
+            FrameHeader.pack(
+                FrameMagic,
+                FrameVersion,
+                flags,
+                raw_offset,
+                mcu_time,
+                len(data),
+                len(comp),
+                crc,
+            )
+        )
+        if clock is not None:
+            self.segment.write(FrameClock.pack(*clock))
+        self.segment.write(comp)
+        record = np.array(
+            [(raw_offset, mcu_time, file_offset, len(data), len(comp), flags, crc)],
+            dtype=FrameIndex,
+        )
+        self.index.write(record.tobytes())
+
+    def _open_segment(self):
+        self.seq += 1
+        name = segment_name(self.base, self.seq)
+        self.log.info(f"Opening capture segment {name}.")
+        self.segment = open(name, "wb")
+        self.index = open(index_name(name), "wb")
+        self.segments.append(name)
+        self._segment_times.append(time.time() * 1000.0)
+        self._segment_start = time.monotonic()
+        self._evict()
+
+    def _close_segment(self):
+        if self.segment is None:
+            return
+        self._sync()
+        self.segment.close()
+        self.index.close()
+        self.segment = None
+        self.index = None
+
+    def _evict(self):
+        # Drop the oldest capture segments in the directory outside the
+        # retention policy: those of earlier sessions first, by when they
+        # were last written, then this session's, each of which ages out
+        # once the next one started before the warm window.
+        own = {os.path.abspath(name) for name in self.segments}
+        pattern = os.path.join(os.path.dirname(self.base), CapturePattern)
+        segments = []
+        for name in glob.glob(pattern):
+            if os.path.abspath(name) in own:
+                continue
+            try:
+                ended = os.path.getmtime(name) * 1000.0
+            except OSError:
+                continue
+            segments.append((ended, name))
+        segments.sort()
+        segments.extend(zip(self._segment_times[1:], self.segments))
+        # The segment being written has no end and is never dropped.
+        segments = [(name, ended, _disk_size(name)) for ended, name in segments]
+        if self.segments:
+            name = self.segments[-1]
+            segments.append((name, None, _disk_size(name)))
+
+        now = time.time() * 1000.0
+        policy = self.retention
+        total = sum(size for _, _, size in segments)
+        while policy is not None and segments and segments[0][1] is not None:
+            name, ended, size = segments[0]
+            old = (
+                policy.warm_hours is not None
+                and now - ended > policy.warm_hours * 3.6e6
+            )
+            full = policy.max_disk_bytes is not None and total > policy.max_disk_bytes
+            if not (old or full):
+                break
+            segments.pop(0)
+            total -= size
+            if self.segments and name == self.segments[0]:
+                self.segments.pop(0)
+                self._segment_times.pop(0)
+            self.log.info(f"Retention: deleting capture segment {name}.")
+            for path in (name, index_name(name)):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    self.log.warning(f"Could not delete {path}: {e}")
+            self._evicted += 1
+            self._evicted_bytes += size
+
+        kept = sum(size for name, _, size in segments if name in self.segments)
+        self.status = dict(
+            warm_start=self._segment_times[0] if self.segments else None,
+            warm_segments=len(self.segments),
+            warm_bytes=kept,
+            other_segments=len(segments) - len(self.segments),
+            other_bytes=total - kept,
+            evicted_segments=self._evicted,
+            evicted_bytes=self._evicted_bytes,
+            error=self.error,
+        )
+
+    def _sync(self):
+        self._last_sync = time.monotonic()
+        if self.segment is None:
+            return
+        for f in (self.segment, self.index):
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def scan_frames(segment, start=0):
+    """Read frame headers from file offset start, stopping at a torn frame."""
+    records = []
+    size = os.path.getsize(segment)
+    with open(segment, "rb") as f:
+        offset = start
+        while offset + FrameHeader.size <= size:
+            f.seek(offset)
+            magic, version, flags, raw_offset, mcu_time, raw_len, comp_len, crc = (
+                FrameHeader.unpack(f.read(FrameHeader.size))
+            )
+            end = offset + _header_size(flags) + comp_len
+            if magic != FrameMagic or end > size:
+                break
+            records.append(
+                (raw_offset, mcu_time, offset, raw_len, comp_len, flags, crc)
+            )
+            offset = end
+    return np.array(records, dtype=FrameIndex)
+
+
+class CaptureReader:
+    """
+    Random access to a raw input capture.
+
+    Accepts either a segmented capture (any of its .cap segments, or the base
+    name) or a plain .in.bin file. Offsets are positions in the raw input
+    stream of the whole session.
+    """
+
+    def __init__(self, path):
+        self.log = logging.getLogger("capture")
+        self.raw = None
+        if path.endswith(".cap"):
+            path = path[: -len(".0000.cap")]
+        if os.path.isfile(path):
+            # Plain raw capture, mapped as a single frame.
+            self.segments = [path]
+            size = os.path.getsize(path)
+            self.frames = np.array([(0, -1, 0, size, 0, 0, 0)], dtype=FrameIndex)
+            self.frame_segment = np.zeros(1, dtype=np.int64)
+            if size:
+                with open(path, "rb") as f:
+                    self.raw = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self.raw = b""
+            return
+
+        self.segments = sorted(
+            glob.glob(f"{glob.escape(path)}.[0-9][0-9][0-9][0-9].cap")
+        )
+        if not self.segments:
+            raise FileNotFoundError(f"No capture found at {path}")
+        frames = []
+        owners = []
+        for k, segment in enumerate(self.segments):
+            index = np.empty(0, dtype=FrameIndex)
+            if os.path.exists(index_name(segment)):
+                index = np.fromfile(index_name(segment), dtype=FrameIndex)
+                # Drop records for frames that never fully made it to disk.
+                end = (
+                    index["file_offset"]
+                    + _header_size(index["flags"])
+                    + index["comp_len"]
+                )
+                index = index[end <= os.path.getsize(segment)]
+            # Pick up any frames written after the index was last flushed.
+            start = 0
+            if len(index):
+                last = index[-1]
+                start = int(last["file_offset"] + _header_size(last["flags"]))
+                start += int(last["comp_len"])
+            index = np.concatenate((index, scan_frames(segment, start)))
+            frames.append(index)
+            owners.append(np.full(len(index), k, dtype=np.int64))
+        self.frames = np.concatenate(frames)
+        self.frame_segment = np.concatenate(owners)
+        self._cache = (None, None)
+        self._walls = None
+
+    @property
+    def size(self):
+        if not len(self.frames):
+            return 0
+        return int(self.frames["raw_offset"][-1] + self.frames["raw_len"][-1])
+
+    @property
+    def start(self):
+        # Raw offset of the oldest byte held (older segments may be deleted).
+        return int(self.frames["raw_offset"][0]) if len(self.frames) else 0
+
+    def find_offset(self, offset):
+        """Return the index of the frame holding raw offset `offset`."""
+        k = np.searchsorted(self.frames["raw_offset"], offset, side="right") - 1
+        return min(max(int(k), 0), len(self.frames) - 1)
+
+    def find_time(self, mcu_time):
+        """
+        Return the raw offset of the last frame whose first packet is at or
+        before mcu_time. Framing from there reaches mcu_time within a frame.
+        """
+        times = self.frames["mcu_time"]
+        known = np.flatnonzero(times >= 0)
+        if not len(known):
+            return self.start
+        k = np.searchsorted(times[known], mcu_time, side="right") - 1
+        # The packet may have started in the previous frame.
+        k = max(int(known[max(k, 0)]) - 1, 0)
+        return int(self.frames["raw_offset"][k])
+
+    def find_wall(self, wall):
+        """
+        Return the raw offset of the last frame whose clock record places
+        its packet at or before wall (ms since the epoch), less one frame as
+        for find_time, or None if the capture has no clock records.
+        """
+        if self._walls is None:
+            self._walls = self._read_walls()
+        known = np.flatnonzero(~np.isnan(self._walls))
+        if not len(known):
+            return None
+        k = np.searchsorted(self._walls[known], wall, side="right") - 1
+        k = max(int(known[max(k, 0)]) - 1, 0)
+        return int(self.frames["raw_offset"][k])
+
+    def _read_walls(self):
+        # Wall times of all the frames' clock records (NaN where none).
+        walls = np.full(len(self.frames), np.nan)
+        if self.raw is not None:
+            return walls
+        flagged = np.flatnonzero(self.frames["flags"] & FlagClock)
+        for s, segment in enumerate(self.segments):
+            with open(segment, "rb") as f:
+                for k in flagged[self.frame_segment[flagged] == s].tolist():
+                    f.seek(int(self.frames["file_offset"][k]) + FrameHeader.size)
+                    walls[k] = FrameClock.unpack(f.read(FrameClock.size))[0]
+        return walls
+
+    def frame(self, k):
+        """Decompressed bytes of frame k."""
+        if self.raw is not None:
+            return self.raw
+        if self._cache[0] == k:
+            return self._cache[1]
+        rec = self.frames[k]
+        with open(self.segments[self.frame_segment[k]], "rb") as f:
+            f.seek(int(rec["file_offset"] + _header_size(rec["flags"])))
+            try:
+                data = zlib.decompress(f.read(int(rec["comp_len"])))
+            except zlib.error:
+                data = None
+        if data is None or zlib.crc32(data) != rec["crc"]:
+            raise ValueError(
+                f"Corrupt capture frame {k} in {self.segments[self.frame_segment[k]]}"
+            )
+        self._cache = (k, data)
+        return data
+
+    def clock(self, k):
+        """
+        (mcu_time, wall, rate) recorded by the live clock for frame k: the
+        wall time (ms) of the first sample of the packet at mcu_time and its
+        period relative to nominal. None if the frame has none.
+        """
+        rec = self.frames[k]
+        if self.raw is not None or not rec["flags"] & FlagClock:
+            return None
+        with open(self.segments[self.frame_segment[k]], "rb") as f:
+            f.seek(int(rec["file_offset"]) + FrameHeader.size)
+            wall, rate = FrameClock.unpack(f.read(FrameClock.size))
+        return int(rec["mcu_time"]), wall, rate
+
+    def chunks(self, start=0, chunk_size=64 * 1024):
+        """Yield (offset, bytes) covering the stream from raw offset start."""
+        start = max(start, self.start)
+        k = self.find_offset(start)
+        while k < len(self.frames):
+            base = int(self.frames["raw_offset"][k])
+            data = self.frame(k)
+            for i in range(max(start - base, 0), len(data), chunk_size):
+                yield base + i, data[i : i + chunk_size]
+            k += 1
+
+    def read(self, start, size):
+        out = bytearray()
+        for offset, chunk in self.chunks(start):
+            out += chunk
+            if len(out) >= size:
+                break
+        return bytes(out[:size])
+
+    def gaps(self):
+        """Raw offsets where the stream was interrupted."""
+        flagged = (self.frames["flags"] & FlagGap) != 0
+        return self.frames["raw_offset"][flagged].astype(np.int64)
+
+    def close(self):
+        if isinstance(self.raw, mmap.mmap):
+            self.raw.close()
+        self.raw = None
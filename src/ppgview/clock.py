@@ -0,0 +1,168 @@
+import math
+import logging
+
+
+class ClockModel:
+    """
+    Maps MCU packet times (uint32 ms) to wall time (ms since the epoch).
+
+    MCU time is unwrapped across the uint32 rollover (about 49.7 days). A
+    backward step is a device reset and starts a new epoch, also across a
+    reconnect or capture gap; only right after seek() (a replay seek) is it
+    taken as a jump within the same timeline instead.
+
+    With fit enabled, offset and drift are fitted incrementally per epoch by
+    exponentially weighted least squares of packet arrival times (host clock,
+    taken when the packet's last sample arrived) against MCU time, forgetting
+    with a time constant of `window` ms. Drift is held at its last estimate
+    until an epoch spans min_span ms and is limited to max_drift; it carries
+    over into new epochs, as it belongs to the crystal. Without fit (replay)
+    MCU time is taken as exact from the first packet's anchor, or follows the
+    mapping the live model recorded with the capture, given by anchor().
+
+    Each packet gets a base (wall time of its first sample) and a period (ms
+    per sample, the nominal period corrected for drift). Bases never go back
+    within an epoch, so jitter in the fit cannot reorder samples: when the
+    fit steps back, packets continue from the last one with their period
+    shortened (to no less than min_period of it) until they meet the fit
+    again, rather than staying ahead of it.
+    """
+
+    def __init__(
+        self,
+        fit=True,
+        window=3_600_000,
+        min_span=60_000,
+        max_drift=500e-6,
+        min_period=0.9,
+    ):
+        self.log = logging.getLogger("clock")
+        self.fit = fit
+        self.min_period = min_period
+        self.window = window
+        self.min_span = min_span
+        self.max_drift = max_drift
+        self.drift = 0.0
+        self.reset()
+
+    def reset(self, start=None):
+        # New session. start is the wall time of its first packet, used if
+        # that packet has no arrival time.
+        self.start = start
+        self.last_raw = None
+        self.unwrapped = 0
+        self.seeking = False
+        self.epochs = 0
+        self.last_end = None
+        self.pending = {}
+
+    def anchor(self, mcu, wall, rate):
+        # Place the packet at MCU time mcu, if it comes soon, as the live
+        # model did: first sample at wall, period rate times nominal.
+        self.pending[mcu] = (wall, rate)
+        if len(self.pending) > 4:
+            del self.pending[next(iter(self.pending))]
+
+    def seek(self):
+        # The stream was moved within the same timeline (a replay seek): the
+        # next packet may be from before the last one.
+        self.seeking = True
+
+    def _new_epoch(self, arrival, x):
+        if arrival is not None:
+            anchor = arrival
+        elif self.last_end is not None:
+            anchor = self.last_end
+        elif self.start is not None:
+            anchor = self.start
+        else:
+            anchor = 0.0
+        self.epochs += 1
+        self.x0 = x
+        self.offset = anchor
+        self.sums = [0.0] * 5  # S, Sx, Sy, Sxx, Sxy
+        self.sums_u = 0.0
+        self.y0 = None
+        self.last_x = x
+        self.last_end = None
+        self.log.info(f"Clock epoch {self.epochs} at MCU {x} ms = {anchor:.0f} ms.")
+
+    def update(self, mcu, N, dt, arrival=None):
+        """
+        Return (base, period) for a packet with MCU time mcu, N samples of
+        nominal period dt ms, whose last sample arrived at `arrival` (wall
+        ms, or None if unknown).
+        """
+        fresh = self.last_raw is None or self.seeking
+        if self.last_raw is None:
+            self.unwrapped = mcu
+            self._new_epoch(arrival, mcu)
+        else:
+            step = (mcu - self.last_raw) & 0xFFFFFFFF
+            if step < 2**31:
+                self.unwrapped += step
+            elif self.seeking:
+                self.unwrapped -= 2**32 - step
+            else:
+                self.unwrapped = mcu
+                self._new_epoch(arrival, mcu)
+        self.last_raw = mcu
+        self.seeking = False
+        x = self.unwrapped
+
+        if self.fit and arrival is not None:
+            self._observe(x + N * dt, arrival)
+        anchor = self.pending.pop(mcu, None) if self.pending else None
+        if anchor is not None:
+            self._anchor(x, *anchor)
+        elif fresh and self.pending:
+            # Nothing to go on after a seek: count back from the next anchor.
+            ahead = min(self.pending, key=lambda m: (m - mcu) & 0xFFFFFFFF)
+            step = (ahead - mcu) & 0xFFFFFFFF
+            if step < 2**31:
+                self._anchor(x + step, *self.pending[ahead])
+
+        base = self.offset + (x - self.x0) * (1.0 + self.drift)
+        period = dt * (1.0 + self.drift)
+        if self.last_end is not None and x >= self.last_x and base < self.last_end:
+            # The fit went back: carry on from the last packet, shortening
+            # the period so the series converges back onto the fit.
+            end = base + N * period
+            base = self.last_end
+            period = max((end - base) / N, self.min_period * period)
+        self.last_x = x
+        self.last_end = base + N * period
+        return base, period
+
+    def _anchor(self, x, wall, rate):
+        self.x0 = x
+        self.offset = wall
+        self.drift = rate - 1.0
+        self.last_end = None
+
+    def _observe(self, x, arrival):
+        # Fit arrival = offset + (1 + drift) * (x - x0), i.e. the residual
+        # y = arrival - x against u = x - x0. Both are kept small (y relative
+        # to its first value) so the sums don't lose precision.
+        if self.y0 is None:
+            self.y0 = arrival - x
+        u = x - self.x0
+        y = arrival - x - self.y0
+        S, Sx, Sy, Sxx, Sxy = self.sums
+        decay = math.exp(-max(u - self.sums_u, 0.0) / self.window) if S else 1.0
+        self.sums_u = u
+        S = S * decay + 1.0
+        Sx = Sx * decay + u
+        Sy = Sy * decay + y
+        Sxx = Sxx * decay + u * u
+        Sxy = Sxy * decay + u * y
+        self.sums = [S, Sx, Sy, Sxx, Sxy]
+
+        mx = Sx / S
+        var = Sxx / S - mx * mx
+        if u >= self.min_span and var > 0:
+            drift = (Sxy / S - mx * Sy / S) / var
+            self.drift = min(max(drift, -self.max_drift), self.max_drift)
+        # Offset at u = 0 (x = x0) given the drift; y includes the fixed
+        # link latency, which the offset absorbs.
+        self.offset = self.x0 + self.y0 + Sy / S - self.drift * mx
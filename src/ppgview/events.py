@@ -0,0 +1,304 @@
+import os
+import re
+import json
+import bisect
+import logging
+
+from dataclasses import dataclass, field, asdict
+
+from ppgview import packet
+
+# Session events on the timeline of the samples (ms since the epoch):
+# operator marks from the UI, and configuration changes, packet loss,
+# reconnects and clipping episodes found in the packet stream. They are kept
+# next to the capture as <base>.events.jsonl, one JSON object per line,
+# appended as they happen.
+
+EventTypes = ("mark", "config", "pid_gap", "reconnect", "clipping")
+
+# Settings compared to report configuration changes.
+ConfigFields = (
+    "adc_range",
+    "sample_rate",
+    "pulse_width",
+    "sample_avg",
+    "red_pa",
+    "ir_pa",
+)
+
+
+def events_path(capture):
+    """Event file of a capture: a .in.bin file, a .cap segment or its base."""
+    base = re.sub(r"\.\d{4}\.cap$", "", capture)
+    base = re.sub(r"\.in(\.bin)?$", "", base)
+    return f"{base}.events.jsonl"
+
+
+def has_detected(path):
+    """Whether the event file at path holds automatic (not mark) events."""
+    if not os.path.exists(path):
+        return False
+    with open(path) as f:
+        for line in f:
+            try:
+                if json.loads(line).get("type") not in (None, "mark"):
+                    return True
+            except (ValueError, AttributeError):
+                pass
+    return False
+
+
+@dataclass
+class Event:
+    type: str
+    start: float
+    end: float
+    label: str = ""
+    data: dict = field(default_factory=dict)
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+
+class EventStore:
+    """
+    Sorted, per-type index of events.
+
+    Each type keeps its events ordered by start time, with the start times in
+    a parallel list and the longest duration seen, so the events overlapping
+    a time range are found by bisection: those starting before the range
+    ends and no earlier than its start less the longest duration. Events
+    mostly arrive in time order and are appended; late ones are inserted in
+    place. An event with the type and start of one already held is a repeat
+    (a replay passing the same spot again) and is dropped.
+
+    version changes whenever the contents do, so views can tell when to
+    redraw.
+    """
+
+    def __init__(self, path=None):
+        self.log = logging.getLogger("events")
+        self.path = None
+        self.file = None
+        self.version = 0
+        self._clear()
+        if path is not None:
+            self.open(path)
+
+    def _clear(self):
+        self._starts = {}
+        self._events = {}
+        self._longest = {}
+        self.version += 1
+
+    def __len__(self):
+        return sum(len(starts) for starts in self._starts.values())
+
+    @property
+    def types(self):
+        return sorted(self._starts)
+
+    def open(self, path):
+        # Switch to the event file of another capture, loading what it holds.
+        self.close()
+        self._clear()
+        self.path = path
+        if not os.path.exists(path):
+            return
+        with open(path) as f:
+            for n, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    self._insert(Event(**json.loads(line)))
+                except (ValueError, TypeError):
+                    self.log.warning(f"Skipping bad event on line {n} of {path}.")
+        self.log.info(f"Loaded {len(self)} events from {path}.")
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def add(self, type, start, end=None, label="", persist=True, **data):
+        """
+        Add an event from start to end (ms; an instant if end is None) and,
+        if persist, append it to the file. Returns the Event, or None if it
+        was a repeat.
+        """
+        end = start if end is None else end
+        event = Event(type, float(start), float(end), label, data)
+        if not self._insert(event):
+            return None
+        if persist and self.path is not None:
+            if self.file is None:
+                self.file = open(self.path, "a")
+            self.file.write(json.dumps(asdict(event)) + "\n")
+            self.file.flush()
+        return event
+
+    def _insert(self, event):
+        starts = self._starts.setdefault(event.type, [])
+        events = self._events.setdefault(event.type, [])
+        k = bisect.bisect_left(starts, event.start)
+        if k < len(starts) and starts[k] == event.start:
+            return False
+        starts.insert(k, event.start)
+        events.insert(k, event)
+        longest = self._longest.get(event.type, 0.0)
+        self._longest[event.type] = max(longest, event.duration)
+        self.version += 1
+        return True
+
+    def _select(self, types):
+        if types is None:
+            return list(self._starts)
+        return [t for t in types if t in self._starts]
+
+    def query(self, start=None, end=None, types=None):
+        """
+        Return the events overlapping [start, end] (ms, None for no bound),
+        of the given types (all if None), ordered by start.
+        """
+        found = []
+        for t in self._select(types):
+            starts = self._starts[t]
+            lo = 0
+            if start is not None:
+                lo = bisect.bisect_left(starts, start - self._longest[t])
+            hi = len(starts)
+            if end is not None:
+                hi = bisect.bisect_right(starts, end)
+            found.extend(
+                e for e in self._events[t][lo:hi] if start is None or e.end >= start
+            )
+        found.sort(key=lambda e: e.start)
+        return found
+
+    def next(self, t, types=None):
+        """First event starting after time t, or None."""
+        found = None
+        for name in self._select(types):
+            k = bisect.bisect_right(self._starts[name], t)
+            if k < len(self._starts[name]):
+                event = self._events[name][k]
+                if found is None or event.start < found.start:
+                    found = event
+        return found
+
+    def previous(self, t, types=None):
+        """Last event starting before time t, or None."""
+        found = None
+        for name in self._select(types):
+            k = bisect.bisect_left(self._starts[name], t)
+            if k > 0:
+                event = self._events[name][k - 1]
+                if found is None or event.start > found.start:
+                    found = event
+        return found
+
+
+class EventDetector:
+    """
+    Automatic events from the packet stream, run in the ingest process on
+    every packet with its wall time (base, period from the clock model).
+
+    Reports configuration changes, lost packets (pid gaps) and reconnects
+    as the span of missing data, and clipping episodes: runs of packets with
+    samples at or above clip_level of full scale in any channel, reported
+    once the episode is over.
+    """
+
+    def __init__(self, clip_level=0.98):
+        self.clip_level = clip_level
+        self.reset()
+
+    def reset(self):
+        # New session, or a seek: nothing carries over.
+        self.last_pid = None
+        self.last_end = None
+        self.last_config = None
+        self.last_settings = None
+        self.reconnected = False
+        self.clip_start = None
+        self.clip_end = None
+        self.clip_channels = set()
+
+    def discontinuity(self):
+        # The link dropped; the next packet reports a reconnect rather than
+        # a pid gap.
+        self.reconnected = True
+
+    def update(self, pkt, base, period):
+        """
+        Return the events (dicts of EventStore.add arguments) this packet
+        ends, as a tuple. Nothing is allocated for a packet that ends none.
+        """
+        events = ()
+        if self.last_end is not None:
+            if self.reconnected:
+                events += (dict(type="reconnect", start=self.last_end, end=base),)
+            else:
+                lost = (pkt.pid - self.last_pid - 1) & 0xFFFF
+                if lost:
+                    events += (
+                        dict(
+                            type="pid_gap",
+                            start=self.last_end,
+                            end=base,
+                            label=f"{lost} packets lost",
+                            lost=lost,
+                        ),
+                    )
+        self.reconnected = False
+        self.last_pid = pkt.pid
+        end = base + pkt.N * period
+        self.last_end = end
+
+        # Compare the packed registers; decode only when they change.
+        config = pkt.config
+        if config != self.last_config:
+            settings = {k: getattr(pkt, k) for k in ConfigFields}
+            if self.last_settings is not None:
+                changes = [
+                    f"{k} {self.last_settings[k]}→{v}"
+                    for k, v in settings.items()
+                    if v != self.last_settings[k]
+                ]
+                events += (
+                    dict(
+                        type="config",
+                        start=base,
+                        label=", ".join(changes),
+                        **settings,
+                    ),
+                )
+            self.last_config = config
+            self.last_settings = settings
+
+        samples = pkt.samples
+        limit = self.clip_level * 2**packet.ADCBits
+        if samples.max() >= limit:
+            if self.clip_start is None:
+                self.clip_start = base
+            self.clip_end = end
+            self.clip_channels.update(
+                name
+                for name, peak in zip(pkt.fmt.channels, samples.max(axis=1).tolist())
+                if peak >= limit
+            )
+        elif self.clip_start is not None:
+            channels = [c for c in pkt.fmt.channels if c in self.clip_channels]
+            events += (
+                dict(
+                    type="clipping",
+                    start=self.clip_start,
+                    end=self.clip_end,
+                    label=", ".join(channels),
+                    channels=channels,
+                ),
+            )
+            self.clip_start = None
+            self.clip_channels = set()
+        return events
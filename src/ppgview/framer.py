@@ -0,0 +1,194 @@
+import logging
+
+from dataclasses import dataclass
+
+from ppgview import packet
+
+
+@dataclass
+class FramerStats:
+    packets: int = 0
+    resyncs: int = 0
+    bytes_skipped: int = 0
+    rejected: int = 0
+    pid_gaps: int = 0
+    packets_lost: int = 0
+    last_resync_bytes: int = 0
+
+
+class Framer:
+    """
+    Finds and validates packets in a byte stream.
+
+    A syncword is only the start of a candidate. The header must be a legal
+    encoding (see packet.check_header) and every sample must fit in the
+    18-bit ADC range. It must also be followed by a syncword exactly where
+    its length says the next packet starts, unless that data hasn't arrived
+    yet and the candidate directly continues the last accepted packet (next
+    pid, small forward time step); the first packet after a gap or a resync
+    always waits for it. Syncword-looking runs inside sample data are
+    therefore skipped, and the framer locks back on within one packet after
+    corruption.
+
+    Either frames an existing buffer in place (bytes, bytearray or mmap) or
+    owns a growable buffer that is filled with feed().
+    """
+
+    def __init__(
+        self,
+        buffer=None,
+        start=0,
+        end=None,
+        size=1024 * 1024,
+        old_packets=False,
+        max_N=packet.MaxSamples,
+        max_time_step=10_000,
+        fmt=packet.DefaultFormat,
+    ):
+        self.log = logging.getLogger("framer")
+        self.old_packets = old_packets
+        self.fmt = fmt
+        self.max_N = max_N
+        self.max_time_step = max_time_step
+
+        self.fixed = buffer is not None
+        if self.fixed:
+            self.buf = buffer
+            self.bi = start
+            self.bend = len(buffer) if end is None else end
+        else:
+            self.buf = bytearray(size)
+            self.bi = 0
+            self.bend = 0
+        self.view = memoryview(self.buf)
+
+        self.locked = False
+        self.last_pid = None
+        self.last_time = None
+        self.skipping = 0
+        self.stats = FramerStats()
+
+    def reset(self):
+        # Drop buffered data and the lock, e.g. after a reconnect.
+        if not self.fixed:
+            self.bi = 0
+            self.bend = 0
+        self.locked = False
+        self.last_pid = None
+        self.last_time = None
+        self.skipping = 0
+
+    def feed(self, data):
+        if self.fixed:
+            raise RuntimeError("Cannot feed a framer over a fixed buffer.")
+        n = len(data)
+        if self.bend + n > len(self.buf):
+            # Move the unread tail to the front. If that's not enough room,
+            # move to a bigger buffer instead of resizing in place: packets
+            # handed out earlier may still hold views of the old one.
+            pending = self.bend - self.bi
+            if pending + n > len(self.buf):
+                buf = bytearray(max(2 * len(self.buf), pending + n))
+            else:
+                buf = self.buf
+            buf[:pending] = bytes(self.view[self.bi : self.bend])
+            if buf is not self.buf:
+                self.buf = buf
+                self.view = memoryview(buf)
+            self.bi = 0
+            self.bend = pending
+        self.buf[self.bend : self.bend + n] = data
+        self.bend += n
+
+    def packets(self, final=False):
+        """
+        Yield every packet that can be framed from the buffered data. With
+        final set, the end of the buffer is the end of the stream: a trailing
+        packet is accepted without waiting for the next syncword.
+        """
+        syncword = packet.syncword
+        while True:
+            i = self.buf.find(syncword, self.bi, self.bend)
+            if i < 0:
+                # Hold back what could be the start of a split syncword.
+                keep = 0 if final else len(syncword) - 1
+                self._skip(max(self.bend - keep, self.bi) - self.bi)
+                return
+            self._skip(i - self.bi)
+
+            if self.bend - i < packet.HeaderSize:
+                if final:
+                    self._skip(self.bend - i)
+                return
+
+            try:
+                pkt = packet.parse_header(
+                    self.view[i : self.bend], self.old_packets, self.fmt
+                )
+                packet.check_header(pkt, self.max_N)
+            except packet.PacketInvalid:
+                self._reject(i)
+                continue
+
+            end = i + pkt.len
+            if end > self.bend:
+                if final:
+                    self._reject(i)
+                    continue
+                return
+
+            if pkt.samples.max() >> packet.ADCBits:
+                self._reject(i)
+                continue
+
+            # The next packet's syncword must follow wherever it has arrived.
+            # Only a continuation of the last packet is accepted without it.
+            if end + len(syncword) <= self.bend:
+                if self.buf[end : end + len(syncword)] != syncword:
+                    self._reject(i)
+                    continue
+            elif not final and not self._continues(pkt):
+                # Can't confirm yet, wait for the next packet.
+                return
+
+            self._accept(pkt)
+            self.bi = end
+            yield pkt
+
+    def _continues(self, pkt):
+        if not self.locked:
+            return False
+        step = (pkt.time - self.last_time) & 0xFFFFFFFF
+        return pkt.pid == (self.last_pid + 1) & 0xFFFF and step <= self.max_time_step
+
+    def _accept(self, pkt):
+        if self.last_pid is not None:
+            lost = (pkt.pid - self.last_pid - 1) & 0xFFFF
+            if lost:
+                self.stats.pid_gaps += 1
+                self.stats.packets_lost += lost
+        if self.skipping:
+            self.stats.resyncs += 1
+            self.stats.last_resync_bytes = self.skipping
+            self.log.info(
+                f"Resynchronized at pid {pkt.pid} after skipping {self.skipping} bytes."
+            )
+            self.skipping = 0
+        self.locked = True
+        self.last_pid = pkt.pid
+        self.last_time = pkt.time
+        self.stats.packets += 1
+
+    def _reject(self, i):
+        self.stats.rejected += 1
+        self._skip(i + 1 - self.bi)
+
+    def _skip(self, n):
+        if n <= 0:
+            return
+        if self.locked:
+            self.log.warning(f"Lost packet sync after pid {self.last_pid}.")
+            self.locked = False
+        self.bi += n
+        self.skipping += n
+        self.stats.bytes_skipped += n
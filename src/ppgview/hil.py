@@ -5,6 +5,8 @@ import os
 from typing import Optional
 from multiprocess import Queue
 
+from ppgview.capture import RawLogger
+
 
 class TEGSenseHIL:
     def __init__(
@@ -17,6 +19,7 @@ class TEGSenseHIL:
         connection,
         service,
         output_raw: Optional[str] = None,
+        retention=None,
     ):
         self.log = logging.getLogger(f"tegsense.{name}")
         self.last_ping = 0
@@ -33,8 +36,7 @@ class TEGSenseHIL:
         if output_raw is not None:
             self.output_raw = output_raw
 
-            self.raw_serial_in_fn = f"{self.output_raw}.in.bin"
-            self.raw_serial_in = open(self.raw_serial_in_fn, "wb")
+            self.raw_serial_in = RawLogger(f"{self.output_raw}.in", retention=retention)
 
             self.raw_serial_out_fn = f"{self.output_raw}.out.bin"
             self.raw_serial_out = open(self.raw_serial_out_fn, "wb")
@@ -68,11 +70,6 @@ class TEGSenseHIL:
         if self.raw_serial_in is not None:
             self.raw_serial_in.close()
             self.raw_serial_in = None
-            if os.path.getsize(self.raw_serial_in_fn) == 0:
-                self.log.warning(
-                    f"Input file {self.raw_serial_in_fn} is empty, removing..."
-                )
-                os.remove(self.raw_serial_in_fn)
         if self.raw_serial_out is not None:
             self.raw_serial_out.close()
             self.raw_serial_out = None
@@ -82,6 +79,19 @@ class TEGSenseHIL:
                 )
                 os.remove(self.raw_serial_out_fn)
 
+    def mark_gap(self):
+        if self.raw_serial_in is not None:
+            self.raw_serial_in.mark_gap()
+
+    def mark_time(self, mcu_time, wall=None, rate=1.0):
+        if self.raw_serial_in is not None:
+            self.raw_serial_in.mark_time(mcu_time, wall, rate)
+
+    def capture_status(self):
+        if self.raw_serial_in is not None:
+            return self.raw_serial_in.status
+        return None
+
     def read_uart(self, size: int = -1):
         if size < 0:
             size = self.uart_service.in_waiting
@@ -0,0 +1,272 @@
+import time
+
+from dataclasses import dataclass, field
+
+import numpy as np
+
+from ppgview import packet
+from ppgview.framer import Framer, FramerStats
+
+# Link impairment simulation for testing the framer.
+#
+# A clean byte stream (synthetic, or a recorded capture) is cut into
+# notification-sized chunks and damaged the way a BLE link damages it. The
+# chunks are then fed through a Framer exactly as the receive path does, and
+# what comes out is compared with the packets that went in.
+
+
+def synthetic_stream(
+    n_packets, N=50, fmt=packet.DefaultFormat, cfg=0x27, fifo_cfg=0x00, seed=0
+):
+    """
+    Return n_packets of valid packets as bytes, with a PPG-like waveform
+    (slow pulse on a large DC level plus noise) in every channel.
+    """
+    rng = np.random.default_rng(seed)
+    C = len(fmt)
+    dt = _sample_period(cfg, fifo_cfg)
+    layout = np.dtype([("header", packet.Header), ("samples", "<u4", (C, N))])
+    out = np.zeros(n_packets, dtype=layout)
+
+    header = out["header"]
+    header["sync"] = np.frombuffer(packet.syncword, dtype="<u4")[0]
+    header["time"] = np.arange(n_packets, dtype=np.int64) * int(N * dt)
+    header["pid"] = np.arange(n_packets) & 0xFFFF
+    header["cfg"] = cfg
+    header["fifo_cfg"] = fifo_cfg
+    header["red_pa"] = 0x1F
+    header["ir_pa"] = 0x1F
+    header["N"] = N
+
+    t = np.arange(n_packets * N) * dt / 1000.0
+    pulse = np.sin(2 * np.pi * 1.2 * t) + 0.3 * np.sin(2 * np.pi * 2.4 * t + 1.0)
+    for c in range(C):
+        x = 100_000 + 20_000 * c + 2_000 * pulse + rng.normal(0, 50, len(t))
+        out["samples"][:, c, :] = np.clip(x, 0, 2**packet.ADCBits - 1).reshape(
+            n_packets, N
+        )
+    return out.tobytes()
+
+
+def _sample_period(cfg, fifo_cfg):
+    # Sample period (ms) for a header configuration.
+    return (
+        packet.fifo_cfg_get_SampleAvg(fifo_cfg) / packet.cfg_get_SampleRate(cfg) * 1000
+    )
+
+
+def packet_bounds(data, fmt=packet.DefaultFormat, old_packets=False):
+    """Frame a clean stream and return (starts, ends) of its packets."""
+    framer = Framer(data, old_packets=old_packets, fmt=fmt)
+    starts = []
+    ends = []
+    for pkt in framer.packets(final=True):
+        ends.append(framer.bi)
+        starts.append(framer.bi - pkt.len)
+    return np.array(starts, dtype=np.int64), np.array(ends, dtype=np.int64)
+
+
+class Impairment:
+    """
+    Damage applied to a byte stream on its way to the framer.
+
+    The stream is cut into chunks of fragment[0] to fragment[1] bytes (BLE
+    notifications). Each chunk is dropped with probability drop, and
+    otherwise followed by a repeat of some of its tail with probability
+    duplicate. Every byte has a bit flipped with probability flip. With
+    probability burst a delivery coalesces up to burst_size chunks, as when
+    notifications queue up behind a stalled link.
+    """
+
+    def __init__(
+        self,
+        fragment=(20, 244),
+        drop=0.0,
+        flip=0.0,
+        duplicate=0.0,
+        burst=0.0,
+        burst_size=8,
+        seed=0,
+    ):
+        self.fragment = fragment
+        self.drop = drop
+        self.flip = flip
+        self.duplicate = duplicate
+        self.burst = burst
+        self.burst_size = burst_size
+        self.seed = seed
+
+    def apply(self, data):
+        """
+        Return (deliveries, damage): the byte strings handed to the framer in
+        order, and an (n, 2) array of damaged [start, end) ranges of the
+        original stream. An insertion at offset b is recorded as [b, b).
+        """
+        rng = np.random.default_rng(self.seed)
+        data = bytearray(data)
+        damage = []
+
+        if self.flip > 0:
+            flips = np.flatnonzero(rng.random(len(data)) < self.flip)
+            bits = rng.integers(0, 8, len(flips))
+            buf = np.frombuffer(data, dtype=np.uint8)
+            buf[flips] ^= (1 << bits).astype(np.uint8)
+            damage.extend((p, p + 1) for p in flips.tolist())
+
+        lo, hi = self.fragment
+        sizes = rng.integers(lo, hi + 1, len(data) // max(lo, 1) + 1)
+        bounds = np.concatenate(([0], np.cumsum(sizes)))
+        bounds = bounds[bounds < len(data)].tolist() + [len(data)]
+
+        chunks = []
+        view = memoryview(data)
+        for a, b in zip(bounds[:-1], bounds[1:]):
+            if self.drop > 0 and rng.random() < self.drop:
+                damage.append((a, b))
+                continue
+            chunks.append(bytes(view[a:b]))
+            if self.duplicate > 0 and rng.random() < self.duplicate:
+                n = int(rng.integers(1, b - a + 1))
+                chunks.append(bytes(view[b - n : b]))
+                damage.append((b, b))
+
+        deliveries = []
+        i = 0
+        while i < len(chunks):
+            n = 1
+            if self.burst > 0 and rng.random() < self.burst:
+                n = int(rng.integers(2, self.burst_size + 1))
+            deliveries.append(b"".join(chunks[i : i + n]))
+            i += n
+
+        damage = np.array(sorted(damage), dtype=np.int64).reshape(-1, 2)
+        return deliveries, damage
+
+
+@dataclass
+class ImpairmentReport:
+    packets: int = 0
+    damaged: int = 0
+    recovered: int = 0
+    recovered_intact: int = 0
+    corrupted: int = 0
+    resync_events: int = 0
+    resync_packets_mean: float = 0.0
+    resync_packets_max: int = 0
+    resync_bytes_mean: float = 0.0
+    bytes_in: int = 0
+    seconds: float = 0.0
+    framer: FramerStats = field(default_factory=FramerStats)
+
+    @property
+    def intact(self):
+        return self.packets - self.damaged
+
+    @property
+    def recovered_ratio(self):
+        # Share of the packets that crossed the link intact that came out.
+        return self.recovered_intact / max(self.intact, 1)
+
+    @property
+    def throughput(self):
+        return self.bytes_in / max(self.seconds, 1e-9)
+
+    def __str__(self):
+        return (
+            f"{self.recovered}/{self.packets} packets recovered, "
+            f"{self.recovered_ratio:.2%} of {self.intact} intact, "
+            f"{self.corrupted} corrupted passed; "
+            f"resync {self.resync_packets_mean:.2f} intact packets lost "
+            f"(max {self.resync_packets_max}) and {self.resync_bytes_mean:.0f} bytes "
+            f"per event over {self.resync_events} events; "
+            f"{self.throughput / 1e6:.1f} MB/s"
+        )
+
+
+def evaluate(data, impairment, fmt=packet.DefaultFormat, old_packets=False):
+    """
+    Run data through impairment and a Framer and compare what comes out
+    with what went in.
+
+    A packet is damaged if any impairment touched its bytes, and recovered
+    if the framer returned it byte for byte. After each run of damaged
+    packets, the resync latency is the number of intact packets lost before
+    the framer locks on again, and the stream distance from the first
+    damaged packet to the next recovered one. Throughput is timed over the
+    framing alone.
+    """
+    starts, ends = packet_bounds(data, fmt, old_packets)
+    deliveries, damage = impairment.apply(data)
+    report = ImpairmentReport(packets=len(starts))
+
+    # Mark every packet overlapping a damaged range.
+    damaged = np.zeros(len(starts) + 1, dtype=np.int64)
+    if len(damage):
+        first = np.searchsorted(ends, damage[:, 0], side="right")
+        last = np.searchsorted(starts, damage[:, 1], side="left")
+        hit = first < last
+        np.add.at(damaged, first[hit], 1)
+        np.add.at(damaged, last[hit], -1)
+    damaged = np.cumsum(damaged)[:-1] > 0
+    report.damaged = int(damaged.sum())
+
+    # Timed pass: framing only.
+    framer = Framer(fmt=fmt, old_packets=old_packets)
+    t = time.perf_counter()
+    for chunk in deliveries:
+        framer.feed(chunk)
+        for _ in framer.packets():
+            pass
+    for _ in framer.packets(final=True):
+        pass
+    report.seconds = time.perf_counter() - t
+    report.bytes_in = sum(len(chunk) for chunk in deliveries)
+    report.framer = framer.stats
+
+    # Checking pass: match each packet to its original by MCU time.
+    view = memoryview(data)
+    by_time = {
+        int(np.frombuffer(view[s + 4 : s + 8], "<u4")[0]): k
+        for k, s in enumerate(starts.tolist())
+    }
+    recovered = np.zeros(len(starts), dtype=bool)
+    framer = Framer(fmt=fmt, old_packets=old_packets)
+    for chunk in deliveries + [None]:
+        if chunk is not None:
+            framer.feed(chunk)
+        for pkt in framer.packets(final=chunk is None):
+            k = by_time.get(pkt.time)
+            if k is not None and recovered[k]:
+                continue
+            if k is not None and pkt.buf[: pkt.len] == view[starts[k] : ends[k]]:
+                recovered[k] = True
+            else:
+                report.corrupted += 1
+    report.recovered = int(recovered.sum())
+    report.recovered_intact = int((recovered & ~damaged).sum())
+
+    # Walk the runs of damaged packets.
+    lost = []
+    distance = []
+    k = 0
+    n = len(starts)
+    while k < n:
+        if not damaged[k]:
+            k += 1
+            continue
+        origin = int(starts[k])
+        while k < n and damaged[k]:
+            k += 1
+        j = k
+        while j < n and not (recovered[j] and not damaged[j]):
+            j += 1
+        if j < n:
+            lost.append(int((~damaged[k:j]).sum()))
+            distance.append(int(starts[j]) - origin)
+        k = j
+    if lost:
+        report.resync_events = len(lost)
+        report.resync_packets_mean = float(np.mean(lost))
+        report.resync_packets_max = int(np.max(lost))
+        report.resync_bytes_mean = float(np.mean(distance))
+    return report
@@ -0,0 +1,207 @@
+import sys
+import time
+import signal
+import traceback
+from queue import Empty
+
+import logging
+
+from ppgview import command
+from ppgview.agc import LEDController
+from ppgview.clock import ClockModel
+from ppgview.events import EventDetector, events_path, has_detected
+from ppgview.framer import Framer
+from ppgview.replay import ReplaySource
+from ppgview.ring import SampleRing
+
+
+# Header fields forwarded to the UI so it can sync its controls. The sample
+# arrays themselves never leave this process except through the ring.
+ControlFields = (
+    "adc_range",
+    "sample_rate",
+    "pulse_width",
+    "adc_bits",
+    "sample_avg",
+    "red_pa",
+    "ir_pa",
+    "collection_period",
+    "startup_timeout",
+)
+
+# Seconds between capture retention status updates to the UI.
+StatusInterval = 1.0
+
+# Seconds to wait before connecting again after consecutive errors. The
+# first is short: a dropped link is already retried by the source itself.
+RetryDelays = (0.1, 1.0, 2.0, 5.0)
+
+
+def run(
+    ring_name,
+    ring_capacity,
+    fmt,
+    outgoing,
+    control,
+    events,
+    agc_enabled,
+    replay=None,
+    retention=None,
+):
+    """
+    Acquisition process entry point: read from the sensor, frame and parse
+    packets laid out as fmt (a PacketFormat) and append the samples to the
+    shared ring. When agc_enabled is set, LED currents and ADC range are
+    adjusted here, per packet. With a ReplayControl, a recorded capture is
+    read instead of the sensor. retention (a RetentionPolicy) limits how
+    much of the raw capture is kept on disk.
+
+    Automatic events go to the events queue as ("event", kwargs) for
+    EventStore.add, preceded by ("session", path) naming the event file of
+    each new session. The capture's retention status (RawLogger.status) is
+    sent as ("retention", status) every StatusInterval seconds.
+    """
+    # Only the segment name crosses the process boundary; attach to the
+    # existing block as its single writer.
+    ring = SampleRing(ring_capacity, len(fmt), name=ring_name, create=False)
+
+    # Shutdown is driven by the Bokeh process, which terminates us on exit.
+    # Turn that into a normal exit so the capture files get closed.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+    log = logging.getLogger("ingest")
+    if replay is not None:
+        source = ReplaySource(replay)
+    else:
+        # The BLE stack is only needed here, not by whoever imports this module.
+        from ppgview.ble import TEGSenseBLE
+
+        source = TEGSenseBLE(retention=retention)
+
+    framer = Framer(fmt=fmt)
+    agc = LEDController()
+    # A replay has no arrival times worth fitting; its MCU times are exact.
+    clock = ClockModel(fit=replay is None)
+    detector = EventDetector(agc.clip_level)
+
+    session = None
+    detect = True
+    failures = 0
+    agc_on = False
+    last_status = 0.0
+    try:
+        while True:
+            try:
+                source.connect()
+                framer.reset()
+                agc.reset()
+                last_config = None
+
+                # A reconnect resumes the session on the same timeline.
+                if source.dt != session:
+                    session = source.dt
+                    clock.reset(start=source.dt.timestamp() * 1000.0)
+                    detector.reset()
+                    path = events_path(source.capture_base)
+                    events.put(("session", path))
+                    # A replay shows the events its capture already holds
+                    # rather than finding them again.
+                    detect = replay is None or not has_detected(path)
+                else:
+                    detector.discontinuity()
+
+                # Clear any existing items in the outgoing queue.
+                try:
+                    while True:
+                        outgoing.get_nowait()
+                except Empty:
+                    pass
+
+                # Wait for data.
+                while source.wait_for_data():
+                    arrival = time.time() * 1000.0 if replay is None else None
+                    failures = 0
+
+                    # Start framing afresh if the stream jumped.
+                    if source.discontinuity:
+                        source.discontinuity = False
+                        framer.reset()
+                        if source.seeked:
+                            source.seeked = False
+                            clock.seek()
+                            detector.reset()
+                        else:
+                            detector.discontinuity()
+
+                    # A replay places its packets where the live clock did.
+                    if source.anchors:
+                        for anchor in source.anchors:
+                            if anchor is not None:
+                                clock.anchor(*anchor)
+                        source.anchors = ()
+
+                    # Add data to buffer.
+                    framer.feed(source.data)
+
+                    now = time.monotonic()
+                    if now - last_status >= StatusInterval:
+                        last_status = now
+                        status = source.capture_status()
+                        if status is not None:
+                            events.put(("retention", status))
+
+                    # Send any outgoing commands.
+                    try:
+                        while True:
+                            cmd = outgoing.get_nowait()
+                            which, value = command.parse_command(cmd)
+                            log.info(
+                                f"Sending command: {cmd.hex()} -> {which.name}, {value} (0x{value:X})"
+                            )
+                            source.send(cmd)
+                    except Empty:
+                        pass
+
+                    # Try to parse any available messages.
+                    for pkt in framer.packets():
+                        # Send the header for the controls to update whenever the config changes.
+                        # Compare the packed registers; decode only on a change.
+                        config = pkt.config
+                        if config != last_config:
+                            last_config = config
+                            control.put({k: getattr(pkt, k) for k in ControlFields})
+
+                        source.pace(pkt)
+                        # Arrival is when the notification completing the
+                        # packet came in, i.e. just after its last sample.
+                        base, period = clock.update(pkt.time, pkt.N, pkt.dt, arrival)
+                        source.mark_time(pkt.time, base, period / pkt.dt)
+                        ring.write_packet(pkt, base, period)
+                        # Events found in a replay are shown but not saved.
+                        if detect:
+                            for event in detector.update(pkt, base, period):
+                                events.put(
+                                    ("event", dict(event, persist=replay is None))
+                                )
+
+                        if agc_enabled.is_set():
+                            agc_on = True
+                            for cmd in agc.update(pkt):
+                                source.send(cmd)
+                        elif agc_on:
+                            # Switched off: start afresh when switched back on.
+                            agc_on = False
+                            agc.reset()
+            except Exception:
+                log.error(traceback.format_exc())
+                # Keep the session so connect() can resume it, and back off
+                # while errors repeat without data in between.
+                source.disconnect(close=False)
+                time.sleep(RetryDelays[min(failures, len(RetryDelays) - 1)])
+                failures += 1
+                continue
+    finally:
+        log.info(f"Framing: {framer.stats}")
+        if source.connected:
+            source.disconnect()
@@ -5,6 +5,10 @@ from ppgview import command
 
 syncword = b"\xEF\xBE\xAD\xDE"
 
+HeaderSize = 20
+MaxSamples = 100
+ADCBits = 18
+
 
 class NumpyEncoder(json.JSONEncoder):
     def default(self, obj):
@@ -54,84 +58,291 @@ class PacketInvalid(Exception):
     pass
 
 
-def parse(buf, old_packets=False):
-    if buf[:4] != syncword:
-        raise PacketInvalidSyncword(f"Invalid syncword: 0x{buf[:4].hex()}")
-
-    if old_packets:
-        # Old packet definition:
-        packet = dict(
-            pid=int(np.frombuffer(buf[4:6], dtype="<u2", count=1)[0]),
-            # 2byte pad
-            time=int(np.frombuffer(buf[8:12], dtype="<u4", count=1)[0]),
-            cfg=int(np.frombuffer(buf[12:13], dtype="<u1", count=1)[0]),
-            fifo_cfg=int(np.frombuffer(buf[13:14], dtype="<u1", count=1)[0]),
-            red_pa=int(np.frombuffer(buf[14:15], dtype="<u1", count=1)[0]),
-            ir_pa=int(np.frombuffer(buf[15:16], dtype="<u1", count=1)[0]),
-            N=int(np.frombuffer(buf[16:18], dtype="<u2", count=1)[0]),
-            # 2byte pad
+# New packet definition:
+Header = np.dtype(
+    [
+        ("sync", "<u4"),
+        ("time", "<u4"),
+        ("pid", "<u2"),
+        ("cfg", "u1"),
+        ("fifo_cfg", "u1"),
+        ("cp_cfg", "u1"),
+        ("red_pa", "u1"),
+        ("ir_pa", "u1"),
+        ("pad0", "u1"),
+        ("N", "<u2"),
+        ("pad1", "<u2"),
+    ]
+)
+
+# Old packet definition (no collection mode):
+OldHeader = np.dtype(
+    [
+        ("sync", "<u4"),
+        ("pid", "<u2"),
+        ("pad0", "<u2"),
+        ("time", "<u4"),
+        ("cfg", "u1"),
+        ("fifo_cfg", "u1"),
+        ("red_pa", "u1"),
+        ("ir_pa", "u1"),
+        ("N", "<u2"),
+        ("pad1", "<u2"),
+    ]
+)
+
+
+def adc_to_uA(adc_range):
+    return -1.0 * adc_range / 1000.0 / 2**ADCBits
+
+
+ConfigFields = ("cfg", "fifo_cfg", "cp_cfg", "red_pa", "ir_pa")
+
+
+def unpack_config(config):
+    """Split packed configuration words (Packet.config) into register arrays."""
+    config = np.asarray(config, dtype=np.uint64)
+    return {
+        name: ((config >> np.uint64(8 * k)) & np.uint64(0xFF)).astype(np.uint8)
+        for k, name in enumerate(ConfigFields)
+    }
+
+
+def packet_length(N, channels=2):
+    return HeaderSize + N * 4 * channels
+
+
+class PacketFormat:
+    """
+    Sample layout of a packet: the channel names, in the order their blocks
+    of N samples follow the header. The header does not say which channels
+    the firmware sends, so this is configured to match it.
+    """
+
+    def __init__(self, channels=("red", "ir")):
+        self.channels = tuple(channels)
+        if not self.channels or len(set(self.channels)) != len(self.channels):
+            raise ValueError(f"Invalid channel list: {channels}")
+
+    def __repr__(self):
+        return f"PacketFormat({self.channels})"
+
+    def __eq__(self, other):
+        return isinstance(other, PacketFormat) and self.channels == other.channels
+
+    def __len__(self):
+        return len(self.channels)
+
+    def index(self, name):
+        return self.channels.index(name)
+
+    def packet_length(self, N):
+        return packet_length(N, len(self.channels))
+
+
+DefaultFormat = PacketFormat()
+
+
+class Packet:
+    """
+    A packet as a view over the bytes it was received in.
+
+    The header is a structured record over the first HeaderSize bytes and
+    samples is a (C, N) uint32 view of the ADC counts of the C channels in
+    fmt, so no sample data is copied: per packet there is this object and
+    its small header and sample view objects. The views are only valid as
+    long as the underlying buffer is; the framer reuses its buffer, so
+    consume a packet (or write_into the sample store) before feeding more
+    data.
+    """
+
+    __slots__ = ("buf", "header", "old_packets", "fmt")
+
+    def __init__(self, buf, old_packets=False, fmt=DefaultFormat):
+        if buf[:4] != syncword:
+            raise PacketInvalidSyncword(f"Invalid syncword: 0x{bytes(buf[:4]).hex()}")
+        if len(buf) < HeaderSize:
+            raise PacketTooSmall(f"{len(buf)} < {HeaderSize}")
+        self.buf = buf
+        self.old_packets = old_packets
+        self.fmt = fmt
+        self.header = np.frombuffer(
+            buf, dtype=OldHeader if old_packets else Header, count=1
+        )[0]
+
+    @property
+    def time(self):
+        # MCU time (ms) of the first sample.
+        return int(self.header["time"])
+
+    @property
+    def pid(self):
+        return int(self.header["pid"])
+
+    @property
+    def cfg(self):
+        return int(self.header["cfg"])
+
+    @property
+    def fifo_cfg(self):
+        return int(self.header["fifo_cfg"])
+
+    @property
+    def cp_cfg(self):
+        return 0x00 if self.old_packets else int(self.header["cp_cfg"])
+
+    @property
+    def red_pa(self):
+        return int(self.header["red_pa"])
+
+    @property
+    def ir_pa(self):
+        return int(self.header["ir_pa"])
+
+    @property
+    def N(self):
+        return int(self.header["N"])
+
+    @property
+    def len(self):
+        return self.fmt.packet_length(self.N)
+
+    @property
+    def adc_range(self):
+        return cfg_get_ADCRange(self.cfg)
+
+    @property
+    def sample_rate(self):
+        return cfg_get_SampleRate(self.cfg)
+
+    @property
+    def pulse_width(self):
+        return cfg_get_PulseWidth(self.cfg)
+
+    @property
+    def adc_bits(self):
+        return cfg_get_ADCBits(self.cfg)
+
+    @property
+    def sample_avg(self):
+        return fifo_cfg_get_SampleAvg(self.fifo_cfg)
+
+    @property
+    def collection_period(self):
+        return command.decode_CollectionMode(self.cp_cfg)[0]
+
+    @property
+    def startup_timeout(self):
+        return command.decode_CollectionMode(self.cp_cfg)[1]
+
+    @property
+    def dt(self):
+        # Sample period in ms.
+        return self.sample_avg / self.sample_rate * 1000
+
+    @property
+    def config(self):
+        # All configuration registers packed into one integer; see
+        # unpack_config.
+        return (
+            self.cfg
+            | self.fifo_cfg << 8
+            | self.cp_cfg << 16
+            | self.red_pa << 24
+            | self.ir_pa << 32
         )
-        packet["cp_cfg"] = 0x00
-    else:
-        # New packet definition:
-        packet = dict(
-            time=int(np.frombuffer(buf[4:8], dtype="<u4", count=1)[0]),
-            pid=int(np.frombuffer(buf[8:10], dtype="<u2", count=1)[0]),
-            cfg=int(np.frombuffer(buf[10:11], dtype="<u1", count=1)[0]),
-            fifo_cfg=int(np.frombuffer(buf[11:12], dtype="<u1", count=1)[0]),
-            cp_cfg=int(np.frombuffer(buf[12:13], dtype="<u1", count=1)[0]),
-            red_pa=int(np.frombuffer(buf[13:14], dtype="<u1", count=1)[0]),
-            ir_pa=int(np.frombuffer(buf[14:15], dtype="<u1", count=1)[0]),
-            # 1byte pad
-            N=int(np.frombuffer(buf[16:18], dtype="<u2", count=1)[0]),
-            # 2byte pad
+
+    @property
+    def scale(self):
+        # Converts the raw ADC counts to µA.
+        return adc_to_uA(self.adc_range)
+
+    @property
+    def samples(self):
+        C = len(self.fmt.channels)
+        return np.frombuffer(
+            self.buf, dtype="<u4", count=C * self.N, offset=HeaderSize
+        ).reshape(C, self.N)
+
+    def channel(self, name):
+        return self.samples[self.fmt.index(name)]
+
+    @property
+    def red(self):
+        return self.channel("red")
+
+    @property
+    def ir(self):
+        return self.channel("ir")
+
+    def times(self):
+        return np.arange(self.N) * self.dt + self.time
+
+    def write_into(self, out, start=0):
+        """
+        Copy samples [start, start + out.shape[1]) of every channel into the
+        (C, n) destination, e.g. a window of the sample store.
+        """
+        np.copyto(out, self.samples[:, start : start + out.shape[1]])
+
+    def to_dict(self):
+        # Detached copy in the old dict layout, e.g. for JSON export.
+        return dict(
+            time=self.times(),
+            pid=self.pid,
+            cfg=self.cfg,
+            fifo_cfg=self.fifo_cfg,
+            cp_cfg=self.cp_cfg,
+            red_pa=self.red_pa,
+            ir_pa=self.ir_pa,
+            N=self.N,
+            len=self.len,
+            adc_range=self.adc_range,
+            sample_rate=self.sample_rate,
+            pulse_width=self.pulse_width,
+            adc_bits=self.adc_bits,
+            sample_avg=self.sample_avg,
+            collection_period=self.collection_period,
+            startup_timeout=self.startup_timeout,
+            dt=self.dt,
+            scale=self.scale,
+            **{
+                name: samples.astype(np.uint32)
+                for name, samples in zip(self.fmt.channels, self.samples)
+            },
         )
-    if packet["N"] > 100:
-        raise PacketInvalid(f"Invalid packet length: {packet['N']}")
-    packet["adc_range"] = cfg_get_ADCRange(packet["cfg"])
-    packet["sample_rate"] = cfg_get_SampleRate(packet["cfg"])
-    packet["pulse_width"] = cfg_get_PulseWidth(packet["cfg"])
-    packet["adc_bits"] = cfg_get_ADCBits(packet["cfg"])
-    packet["sample_avg"] = fifo_cfg_get_SampleAvg(packet["fifo_cfg"])
-    (
-        packet["collection_period"],
-        packet["startup_timeout"],
-    ) = command.decode_CollectionMode(packet["cp_cfg"])
-    packet["dt"] = packet["sample_avg"] / packet["sample_rate"] * 1000
-    packet["time"] = np.arange(0, packet["N"]) * packet["dt"] + packet["time"]
-
-    packet["len"] = 4 + 4 + 2 + 1 * 5 + 1 + 2 + 2 + packet["N"] * 4 * 2
-    if len(buf) < packet["len"]:
-        raise PacketTooSmall(f"{len(buf)} < {packet['len']}")
-
-    adc_to_uA = -1.0 * packet["adc_range"] / 1000.0 / 2**18
-    sep = packet["N"] * 4 + 20
-    packet["red"] = (
-        np.frombuffer(buf[20:sep], dtype="<u4", count=packet["N"]) * adc_to_uA
-    )
-    packet["ir"] = (
-        np.frombuffer(buf[sep : packet["len"]], dtype="<u4", count=packet["N"])
-        * adc_to_uA
-    )
 
+
+def parse_header(buf, old_packets=False, fmt=DefaultFormat):
+    return Packet(buf, old_packets, fmt)
+
+
+def check_header(packet, max_N=MaxSamples):
+    # Reject anything the device could not have sent: the reserved bit of the
+    # SpO2 config must be clear, every field must be a legal encoding and
+    # the sample count has to be in range.
+    if packet.N < 1 or packet.N > max_N:
+        raise PacketInvalid(f"Invalid packet length: {packet.N}")
+    if packet.cfg & 0x80:
+        raise PacketInvalid(f"Invalid SpO2 config: 0x{packet.cfg:02X}")
+    try:
+        fifo_cfg_get_SampleAvg(packet.fifo_cfg)
+    except Exception:
+        raise PacketInvalid(f"Invalid FIFO config: 0x{packet.fifo_cfg:02X}")
+
+
+def parse(buf, old_packets=False, fmt=DefaultFormat):
+    packet = Packet(buf, old_packets, fmt)
+    check_header(packet)
+    if len(buf) < packet.len:
+        raise PacketTooSmall(f"{len(buf)} < {packet.len}")
     return packet
 
 
-def parse_all(buffer: bytes, start=0, end=-1):
-    packets = []
-    bi = start
+def parse_all(buffer: bytes, start=0, end=-1, old_packets=False, fmt=DefaultFormat):
+    # Imported here, the framer builds on this module.
+    from ppgview.framer import Framer
+
     bend = end if end >= 0 else len(buffer)
-    try:
-        while True:
-            bi += buffer[bi:bend].find(syncword)
-            pkt = parse(buffer[bi:bend])
-            bi += pkt["len"]
-            packets.append(pkt)
-    except PacketInvalidSyncword:
-        bi += 1
-    except PacketTooSmall:
-        pass
-    except PacketInvalid:
-        bi += 1
-
-    return packets
+    framer = Framer(buffer, start=start, end=bend, old_packets=old_packets, fmt=fmt)
+    return list(framer.packets(final=True))
@@ -0,0 +1,227 @@
+import io
+import json
+import dataclasses
+import datetime as dt
+
+import numpy as np
+
+from tornado.web import RequestHandler, HTTPError
+
+from ppgview import packet
+
+# Local HTTP access to the sample store of a running session.
+#
+#   GET /api/info
+#       JSON: channels, write index, time span held.
+#   GET /api/samples?start=&end=&since=&decimate=&units=&channels=&format=
+#       start/end: ms since the epoch or ISO 8601 local time; since: a ring
+#       index (e.g. `next` from the previous reply) to pull only new samples.
+#       decimate: keep every n-th sample. units: "uA" (float64, default) or
+#       "counts" (uint32). format: "npz" (default, little-endian arrays,
+#       np.load(io.BytesIO(body))) or "arrow" (Arrow IPC stream, needs
+#       pyarrow).
+#   GET /api/events?start=&end=&types=
+#       JSON: the session events overlapping start/end (times as above),
+#       optionally only of the comma-separated types. With next= or
+#       previous= (a time) instead, only the first event starting after it
+#       or the last starting before it, if any.
+#
+# Replies carry the samples' ring indices, their times and channels, and the
+# configuration segments overlapping them (start index, µA scale, registers
+# and decoded settings). truncated is set when the request reaches back past
+# the oldest sample still in memory: those samples are only in the raw
+# capture now. Only requests from this machine are served.
+
+# Largest reply, in samples per channel (after decimation).
+MaxSamples = 20_000_000
+
+LocalAddresses = ("127.0.0.1", "::1")
+
+
+def parse_time(value):
+    # ms since the epoch, or ISO 8601: local time unless it has an offset.
+    try:
+        return int(float(value))
+    except (ValueError, OverflowError):
+        pass
+    try:
+        return int(dt.datetime.fromisoformat(value).timestamp() * 1000)
+    except ValueError:
+        raise HTTPError(400, f"Invalid time: {value}")
+
+
+class LocalHandler(RequestHandler):
+    def initialize(self, ring, fmt, events=None):
+        self.ring = ring
+        self.fmt = fmt
+        self.events = events
+
+    def prepare(self):
+        if self.request.remote_ip not in LocalAddresses:
+            raise HTTPError(403)
+
+    def get_int_argument(self, name, default=None):
+        value = self.get_argument(name, None)
+        if value is None:
+            return default
+        try:
+            return int(value)
+        except ValueError:
+            raise HTTPError(400, f"Invalid {name}: {value}")
+
+
+class InfoHandler(LocalHandler):
+    def get(self):
+        end = self.ring.write_index
+        start = self.ring.oldest(end)
+        info = dict(channels=self.fmt.channels, start=start, end=end)
+        if end > start:
+            _, time, _ = self.ring.read_counts(start, start + 1)
+            info["first_time"] = int(time.view(np.int64)[0])
+            _, time, _ = self.ring.read_counts(end - 1, end)
+            info["last_time"] = int(time.view(np.int64)[0])
+        self.write(info)
+
+
+class EventsHandler(LocalHandler):
+    def get(self):
+        if self.events is None:
+            raise HTTPError(404)
+        start = self.get_argument("start", None)
+        end = self.get_argument("end", None)
+        after = self.get_argument("next", None)
+        before = self.get_argument("previous", None)
+        types = self.get_argument("types", None)
+        types = None if types is None else types.split(",")
+        if after is not None or before is not None:
+            if after is not None:
+                event = self.events.next(parse_time(after), types)
+            else:
+                event = self.events.previous(parse_time(before), types)
+            found = [] if event is None else [event]
+        else:
+            found = self.events.query(
+                None if start is None else parse_time(start),
+                None if end is None else parse_time(end),
+                types,
+            )
+        self.write(dict(events=[dataclasses.asdict(e) for e in found]))
+
+
+class SamplesHandler(LocalHandler):
+    def get(self):
+        ring = self.ring
+        end = ring.write_index
+        oldest = start = ring.oldest(end)
+
+        def dropped(t):
+            # Whether time t is before the oldest sample still held.
+            return oldest > 0 and t < ring.times(oldest, oldest + 1)[0]
+
+        # Set when part of the requested range has already left the ring.
+        truncated = False
+        since = self.get_int_argument("since")
+        if since is not None:
+            start = max(start, since)
+            truncated = since < oldest
+        t = self.get_argument("start", None)
+        if t is not None:
+            t = parse_time(t)
+            start = max(start, ring.find_time(t, end))
+            truncated = truncated or dropped(t)
+        t = self.get_argument("end", None)
+        if t is not None:
+            t = parse_time(t)
+            end = min(end, ring.find_time(t, end))
+            truncated = truncated or dropped(t)
+        end = max(start, end)
+
+        step = max(self.get_int_argument("decimate", 1), 1)
+        units = self.get_argument("units", "uA")
+        if units not in ("uA", "counts"):
+            raise HTTPError(400, f"Invalid units: {units}")
+        output = self.get_argument("format", "npz")
+        if output not in ("npz", "arrow"):
+            raise HTTPError(400, f"Invalid format: {output}")
+        names = self.get_argument("channels", ",".join(self.fmt.channels))
+        try:
+            rows = [self.fmt.index(name) for name in names.split(",")]
+        except ValueError:
+            raise HTTPError(400, f"Unknown channel in {names}")
+        if (end - start) // step > MaxSamples:
+            raise HTTPError(413, "Too many samples; narrow the range or decimate.")
+
+        start, time, counts = ring.read_counts(start, end)
+        index = np.arange(start, end, step, dtype=np.int64)
+        time = time[::step].view(np.int64)
+        counts = counts[rows, ::step]
+
+        seg_start, seg_scale, seg_config = ring.segments()
+        first = max(int(np.searchsorted(seg_start, start, side="right")) - 1, 0)
+        last = int(np.searchsorted(seg_start, end, side="left"))
+        seg_start = seg_start[first:last]
+        seg_scale = seg_scale[first:last]
+        seg_config = seg_config[first:last]
+
+        if units == "uA":
+            if len(seg_start):
+                k = np.searchsorted(seg_start, index, side="right") - 1
+                values = counts * seg_scale[np.maximum(k, 0)]
+            else:
+                values = counts.astype(np.float64)
+        else:
+            values = np.ascontiguousarray(counts)
+
+        arrays = dict(index=index, time=time)
+        arrays.update((self.fmt.channels[r], values[i]) for i, r in enumerate(rows))
+        segments = dict(start=seg_start.astype(np.int64), scale=seg_scale)
+        segments.update(packet.unpack_config(seg_config))
+        segments.update(decode_config(segments))
+        meta = dict(
+            start=start, next=end, decimate=step, units=units, truncated=truncated
+        )
+
+        if output == "npz":
+            self.set_header("Content-Type", "application/octet-stream")
+            self.write(to_npz(arrays, segments, meta))
+        else:
+            self.set_header("Content-Type", "application/vnd.apache.arrow.stream")
+            self.write(to_arrow(arrays, segments, meta))
+
+
+def decode_config(registers):
+    # Human-readable settings of each segment.
+    decoded = dict(adc_range=[], sample_rate=[], pulse_width=[], sample_avg=[])
+    for cfg, fifo_cfg in zip(registers["cfg"].tolist(), registers["fifo_cfg"].tolist()):
+        decoded["adc_range"].append(packet.cfg_get_ADCRange(cfg))
+        decoded["sample_rate"].append(packet.cfg_get_SampleRate(cfg))
+        decoded["pulse_width"].append(packet.cfg_get_PulseWidth(cfg))
+        decoded["sample_avg"].append(packet.fifo_cfg_get_SampleAvg(fifo_cfg))
+    return {k: np.array(v, dtype=np.int64) for k, v in decoded.items()}
+
+
+def to_npz(arrays, segments, meta):
+    out = io.BytesIO()
+    np.savez(
+        out,
+        **arrays,
+        **{f"segment_{k}": v for k, v in segments.items()},
+        **{k: np.array(v) for k, v in meta.items()},
+    )
+    return out.getvalue()
+
+
+def to_arrow(arrays, segments, meta):
+    try:
+        import pyarrow as pa
+    except ImportError:
+        raise HTTPError(501, "Arrow output needs pyarrow.")
+    meta = dict(meta, segments={k: v.tolist() for k, v in segments.items()})
+    batch = pa.RecordBatch.from_pydict(
+        {k: pa.array(v) for k, v in arrays.items()},
+        metadata={"ppgview": json.dumps(meta)},
+    )
+    out = pa.BufferOutputStream()
+    with pa.ipc.new_stream(out, batch.schema) as writer:
+        writer.write_batch(batch)
+    return out.getvalue().to_pybytes()
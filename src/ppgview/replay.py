@@ -0,0 +1,198 @@
+import os
+import re
+import time
+import logging
+import datetime as dt
+
+from multiprocess import Value
+
+from ppgview.capture import CaptureReader
+
+
+class ReplayControl:
+    """
+    Replay settings shared between the Bokeh process and the ingest process.
+
+    speed is the replay rate relative to real time (0 for as fast as
+    possible), seek is a requested position as a fraction of the capture (-1
+    when there is none), seek_time one as a wall time (ms since the epoch,
+    -1 when there is none) and position is the fraction replayed so far.
+    """
+
+    def __init__(self, path, speed=1.0):
+        self.path = path
+        self.speed = Value("d", speed, lock=False)
+        self.seek = Value("d", -1.0, lock=False)
+        self.seek_time = Value("d", -1.0, lock=False)
+        self.position = Value("d", 0.0, lock=False)
+
+
+class ReplaySource:
+    """
+    Feeds a recorded capture through the ingest path in place of the sensor.
+
+    Has the same interface as TEGSenseBLE, plus pace(), which the ingest loop
+    calls for every packet to hold it to the requested speed. Commands are
+    dropped. At the end of the capture it idles until a seek is requested.
+    anchors are the live clock mappings recorded with the frame being read
+    and the next (CaptureReader.clock; a frame's first marked packet may
+    have arrived in the one before), for ClockModel.anchor. The filename
+    stamp only places captures without them.
+
+    A reconnect after an error resumes where the replay was, and a corrupt
+    frame is skipped, so neither sends it back to the start.
+    """
+
+    def __init__(self, control: ReplayControl):
+        self.log = logging.getLogger("replay")
+        self.control = control
+        self.capture = None
+        self.chunks = None
+        self.data = None
+        self.dt = None
+        self.capture_base = control.path
+        self.discontinuity = False
+        self.seeked = False
+        self.anchors = ()
+        self.frame = None
+
+    @property
+    def connected(self):
+        return self.capture is not None
+
+    def connect(self):
+        if self.capture is not None:
+            # Resuming after disconnect(close=False): carry on from here.
+            self.log.info(f"Resuming replay at offset {self.offset}.")
+            self.discontinuity = True
+            return
+        path = self.control.path
+        self.capture = CaptureReader(path)
+        self.log.info(f"Replaying {path} ({self.capture.size} bytes).")
+        self.gaps = set(self.capture.gaps().tolist())
+
+        # Put samples on the timeline they were recorded on, if we know it.
+        stamp = re.search(r"(\d{8}_\d{6})", os.path.basename(path))
+        if stamp:
+            self.dt = dt.datetime.strptime(stamp.group(1), "%Y%m%d_%H%M%S").astimezone()
+        else:
+            self.dt = dt.datetime.now().astimezone()
+        self._seek(self.capture.start)
+
+    def disconnect(self, close=True):
+        if close and self.capture is not None:
+            self.capture.close()
+            self.capture = None
+
+    def _seek(self, offset):
+        self.chunks = self.capture.chunks(offset)
+        self.offset = offset
+        self.frame = None
+        self.discontinuity = True
+        self.seeked = True
+        self.origin = None
+        self.started = time.monotonic()
+        self.replayed = 0
+        self.finished = False
+
+    def wait_for_data(self):
+        if self.capture is None:
+            raise RuntimeError("Capture not open!")
+        while True:
+            seek = self.control.seek.value
+            if seek >= 0:
+                self.control.seek.value = -1.0
+                start, size = self.capture.start, self.capture.size
+                offset = start + int(seek * (size - start))
+                self.log.info(f"Seeking to {seek:.1%} (offset {offset}).")
+                self._seek(offset)
+            when = self.control.seek_time.value
+            if when >= 0:
+                self.control.seek_time.value = -1.0
+                offset = self._find_wall(when)
+                self.log.info(f"Seeking to {when:.0f} ms (offset {offset}).")
+                self._seek(offset)
+
+            if not self.finished:
+                try:
+                    offset, data = next(self.chunks)
+                except StopIteration:
+                    pass
+                except ValueError as e:
+                    self._skip_frame(e)
+                    continue
+                else:
+                    # Frames recorded after a dropout don't continue the last.
+                    if offset in self.gaps:
+                        self.discontinuity = True
+                    # Where the live clock put this frame's samples.
+                    k = self.capture.find_offset(offset)
+                    if k != self.frame:
+                        self.frame = k
+                        ks = range(k, min(k + 2, len(self.capture.frames)))
+                        self.anchors = [self.capture.clock(j) for j in ks]
+                    self.offset = offset + len(data)
+                    self.replayed += len(data)
+                    self.control.position.value = self.offset / max(
+                        self.capture.size, 1
+                    )
+                    self.data = data
+                    return data
+
+                self.finished = True
+                elapsed = time.monotonic() - self.started
+                self.log.info(
+                    f"End of capture: replayed {self.replayed} bytes in {elapsed:.2f} s "
+                    f"({self.replayed / max(elapsed, 1e-9) / 1e6:.2f} MB/s)."
+                )
+            time.sleep(0.05)
+
+    def _find_wall(self, wall):
+        offset = self.capture.find_wall(wall)
+        if offset is None:
+            # No clock records: the timeline starts at the stamp.
+            times = self.capture.frames["mcu_time"]
+            first = int(times[times >= 0][0]) if (times >= 0).any() else 0
+            offset = self.capture.find_time(
+                first + int(wall - self.dt.timestamp() * 1000.0)
+            )
+        return offset
+
+    def _skip_frame(self, error):
+        # The frame at self.offset can't be read; go on from the next one.
+        frames = self.capture.frames
+        k = self.capture.find_offset(self.offset) + 1
+        self.log.error(f"Skipping unreadable capture frame: {error}")
+        if k < len(frames):
+            self.chunks = self.capture.chunks(int(frames["raw_offset"][k]))
+        else:
+            self.chunks = iter(())
+        self.discontinuity = True
+
+    def pace(self, pkt):
+        speed = self.control.speed.value
+        if speed <= 0:
+            return
+        now = time.monotonic()
+        if self.origin is None or self.origin[2] != speed:
+            self.origin = (now, pkt.time, speed)
+            return
+        wall, mcu, _ = self.origin
+        step = (pkt.time - mcu) & 0xFFFFFFFF
+        if step > 2**31:
+            # MCU time went backwards (device reset); start pacing afresh.
+            self.origin = (now, pkt.time, speed)
+            return
+        delay = wall + step / 1000.0 / speed - now
+        if delay > 0:
+            time.sleep(delay)
+
+    def mark_time(self, mcu_time, wall=None, rate=1.0):
+        pass
+
+    def capture_status(self):
+        # Nothing is captured or evicted during a replay.
+        return None
+
+    def send(self, cmd):
+        self.log.info(f"Replay: dropping command {cmd.hex()}.")
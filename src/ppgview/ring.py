@@ -0,0 +1,266 @@
+import numpy as np
+
+from multiprocess import shared_memory
+
+
+class SampleRing:
+    """
+    Single-producer, single-consumer sample ring in shared memory.
+
+    The ingest process owns the write side and the Bokeh process maps the same
+    block read-only. There are no locks: the writer fills the sample columns
+    first and only then publishes the new write index, so the reader never
+    sees an index that points past valid data. Indices increase monotonically
+    and are reduced modulo the capacity on access.
+
+    Samples are kept as the raw ADC counts in a single channel-major
+    (channels, capacity) array, so a packet is stored with one copy per wrap
+    run whatever its channel count. The counts-to-µA scale and the device
+    configuration live in a small segment table (a new segment starts
+    whenever the configuration changes); the scale is applied on read, only
+    to the requested slice.
+
+    Time is not stored per sample. A packet table holds the ring index,
+    wall time (ms since the epoch) and sample period of each packet, and
+    sample times are computed on read. The table holds capacity / 16 packets,
+    so with very short packets the oldest samples drop out before the ring
+    wraps.
+    """
+
+    # Header layout (int64 words): write index, capacity, segment count,
+    # channel count, packet count.
+    HeaderSize = 64
+    MaxSegments = 65536
+    PacketRatio = 16
+
+    packet_columns = (
+        ("pkt_start", np.dtype(np.int64)),
+        ("pkt_base", np.dtype(np.float64)),
+        ("pkt_period", np.dtype(np.float64)),
+    )
+
+    segment_columns = (
+        ("seg_start", np.dtype(np.int64)),
+        ("seg_scale", np.dtype(np.float64)),
+        ("seg_config", np.dtype(np.uint64)),
+    )
+
+    def __init__(
+        self, capacity: int, channels=2, name=None, create=True, writable=True
+    ):
+        self.capacity = int(capacity)
+        self.channels = int(channels)
+        self.max_packets = max(self.capacity // self.PacketRatio, 1024)
+        self.writable = writable
+        size = (
+            self.HeaderSize
+            + sum(dt.itemsize for _, dt in self.packet_columns) * self.max_packets
+            + sum(dt.itemsize for _, dt in self.segment_columns) * self.MaxSegments
+            + 4 * self.channels * self.capacity
+        )
+        self.shm = shared_memory.SharedMemory(name=name, create=create, size=size)
+        self.owner = create
+
+        self._header = np.ndarray(5, dtype=np.int64, buffer=self.shm.buf)
+        if create:
+            self._header[:] = (0, self.capacity, 0, self.channels, 0)
+        elif self._header[3] != self.channels:
+            found = int(self._header[3])
+            self._header = None
+            self.shm.close()
+            raise ValueError(f"Sample ring has {found} channels, not {self.channels}.")
+
+        offset = self.HeaderSize
+        for columns, length in (
+            (self.packet_columns, self.max_packets),
+            (self.segment_columns, self.MaxSegments),
+        ):
+            for column, dtype in columns:
+                array = np.ndarray(
+                    length, dtype=dtype, buffer=self.shm.buf, offset=offset
+                )
+                if not writable:
+                    array.flags.writeable = False
+                setattr(self, column, array)
+                offset += dtype.itemsize * length
+
+        # Raw counts of every channel, one row per channel. Last, so the
+        # 8-byte columns above stay aligned.
+        self.samples = np.ndarray(
+            (self.channels, self.capacity),
+            dtype=np.uint32,
+            buffer=self.shm.buf,
+            offset=offset,
+        )
+        if not writable:
+            self.samples.flags.writeable = False
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    @property
+    def write_index(self):
+        # Still answers after close(), with the last index seen.
+        if self._header is None:
+            return self._closed_index
+        return int(self._header[0])
+
+    def write_packet(self, pkt, base, period):
+        """
+        Append a packet's samples, copied straight from the packet's view.
+        base is the wall time (ms since the epoch) of its first sample and
+        period the time between samples (ms).
+        """
+        if not self.writable:
+            raise RuntimeError("Sample ring is mapped read-only.")
+        N = pkt.N
+        wi = self.write_index
+
+        # Open a new segment if the device configuration changed.
+        config = pkt.config
+        n = int(self._header[2])
+        if n == 0 or self.seg_config[(n - 1) % self.MaxSegments] != config:
+            self.seg_start[n % self.MaxSegments] = wi
+            self.seg_scale[n % self.MaxSegments] = pkt.scale
+            self.seg_config[n % self.MaxSegments] = config
+            self._header[2] = n + 1
+
+        n = int(self._header[4])
+        k = n % self.max_packets
+        self.pkt_start[k] = wi
+        self.pkt_base[k] = base
+        self.pkt_period[k] = period
+        self._header[4] = n + 1
+
+        # At most two runs if the packet wraps around the end of the ring.
+        start = wi % self.capacity
+        first = min(N, self.capacity - start)
+        for dst, src, count in ((start, 0, first), (0, first, N - first)):
+            if count:
+                pkt.write_into(self.samples[:, dst : dst + count], src)
+
+        # Publish only after the samples are in place.
+        self._header[0] = wi + N
+
+    def segments(self):
+        """
+        Return (start, scale, config) of the segments still held, oldest
+        first. config is the packed header configuration (Packet.config).
+        """
+        n = int(self._header[2])
+        idx = np.arange(max(0, n - self.MaxSegments), n) % self.MaxSegments
+        return self.seg_start[idx], self.seg_scale[idx], self.seg_config[idx]
+
+    def _search_packets(self, column, value, side="left"):
+        # searchsorted over the packet table entries still held, which are at
+        # most two contiguous runs. Returns a packet number.
+        n = int(self._header[4])
+        k = max(0, n - self.max_packets)
+        while k < n:
+            s = k % self.max_packets
+            e = min(s + n - k, self.max_packets)
+            j = int(np.searchsorted(column[s:e], value, side=side))
+            if j < e - s:
+                return k + j
+            k += e - s
+        return n
+
+    def oldest(self, end=None):
+        """Index of the oldest sample that still has data and a time."""
+        end = self.write_index if end is None else end
+        n = int(self._header[4])
+        start = max(0, end - self.capacity)
+        if n > self.max_packets:
+            start = max(start, int(self.pkt_start[n % self.max_packets]))
+        return start
+
+    def times(self, start: int, end: int):
+        """Wall times (ms since the epoch, int64) of samples [start, end)."""
+        P = self.max_packets
+        first = max(
+            self._search_packets(self.pkt_start, start, "right") - 1,
+            int(self._header[4]) - P,
+            0,
+        )
+        last = self._search_packets(self.pkt_start, end, "left")
+        idx = np.arange(first, last) % P
+        pkt_start = self.pkt_start[idx]
+
+        # Samples of each packet that fall in [start, end).
+        bounds = np.clip(np.append(pkt_start, end), start, end)
+        k = np.repeat(idx, np.diff(bounds))
+        i = np.arange(start, end)
+        t = self.pkt_base[k] + (i - self.pkt_start[k]) * self.pkt_period[k]
+        return np.rint(t).astype(np.int64)
+
+    def find_time(self, t, end=None):
+        """
+        Return the index of the first sample held at or after time t (ms
+        since the epoch), or end (the write index) if there is none. Times
+        are assumed to increase, which holds except across a backward
+        replay seek.
+        """
+        end = self.write_index if end is None else end
+        oldest = self.oldest(end)
+        k = self._search_packets(self.pkt_base, t, "left")
+        n = int(self._header[4])
+        index = end if k >= n else int(self.pkt_start[k % self.max_packets])
+        if k > max(0, n - self.max_packets):
+            # The sample may be inside the previous packet.
+            j = (k - 1) % self.max_packets
+            step = np.ceil((t - self.pkt_base[j]) / self.pkt_period[j])
+            index = min(index, int(self.pkt_start[j]) + int(step))
+        return min(max(index, oldest), end)
+
+    def read_counts(self, start: int, end: int):
+        """
+        Return (start, time, counts) with the sample times (datetime64[ms])
+        and the raw counts, shape (C, n), for samples in [start, end). If the
+        writer has lapped the reader, start is advanced to the oldest sample
+        still held. Count slices that do not wrap are returned as views.
+        """
+        start = min(max(start, self.oldest(end)), end)
+        time = self.times(start, end).view("datetime64[ms]")
+        s = start % self.capacity
+        e = s + (end - start)
+        if e <= self.capacity:
+            return start, time, self.samples[:, s:e]
+
+        e -= self.capacity
+        return (
+            start,
+            time,
+            np.concatenate((self.samples[:, s:], self.samples[:, :e]), axis=1),
+        )
+
+    def read(self, start: int, end: int):
+        """
+        Return (start, time, values) for samples in [start, end), with every
+        channel converted to µA.
+        """
+        seg_start, seg_scale, _ = self.segments()
+        if len(seg_start):
+            start = max(start, int(seg_start[0]))
+        start, time, counts = self.read_counts(start, end)
+
+        # Scale one run per segment straight into the output.
+        values = np.empty(counts.shape)
+        first = max(np.searchsorted(seg_start, start, side="right") - 1, 0)
+        last = np.searchsorted(seg_start, end, side="left")
+        for k in range(first, last):
+            a = max(int(seg_start[k]) - start, 0)
+            b = (int(seg_start[k + 1]) if k + 1 < len(seg_start) else end) - start
+            np.multiply(counts[:, a:b], seg_scale[k], out=values[:, a:b])
+        return start, time, values
+
+    def close(self):
+        # Drop our array views before releasing the mapping.
+        for column, _ in self.packet_columns + self.segment_columns:
+            setattr(self, column, None)
+        self.samples = None
+        self._closed_index = int(self._header[0])
+        self._header = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
@@ -6,14 +6,16 @@ from ppgview import hil
 
 
 class TEGSenseSensor:
-    def __init__(self, name, ble, advertisement, qout, qin, pq, nowstamp):
+    def __init__(
+        self, name, ble, advertisement, qout, qin, pq, nowstamp, retention=None
+    ):
         self.name = name
         self.ble = ble
         self.advertisement = advertisement
         self.connection = None
         self.service = None
         self.hil = hil.TEGSenseHIL(
-            name, qout, qin, pq, advertisement, None, None, nowstamp
+            name, qout, qin, pq, advertisement, None, None, nowstamp, retention
         )
 
     def disconnect(self):
@@ -0,0 +1,70 @@
+import numpy as np
+
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+def default_nfft(fs, seconds=2.0):
+    # Power of two closest to the requested window length.
+    return int(2 ** np.clip(np.round(np.log2(fs * seconds)), 6, 12))
+
+
+class StreamingSTFT:
+    """
+    Incremental short-time Fourier transform of a sample stream.
+
+    Samples are fed in as they arrive; each call transforms only the windows
+    completed since the last one (Hann window, per-window mean removed), so
+    the cost is linear in the incoming samples regardless of how much
+    history is displayed. A running Welch PSD is kept as an exponential
+    average over roughly psd_average windows.
+    """
+
+    def __init__(self, fs, nfft=None, hop=None, psd_average=32):
+        self.fs = fs
+        self.nfft = default_nfft(fs) if nfft is None else nfft
+        self.hop = self.nfft // 4 if hop is None else hop
+        self.window = np.hanning(self.nfft)
+        # One-sided PSD density scaling.
+        self.scale = 2.0 / (fs * (self.window**2).sum())
+        self.freqs = np.fft.rfftfreq(self.nfft, 1.0 / fs)
+        self.alpha = 1.0 / psd_average
+
+        self.pending = np.empty(0)
+        # Absolute sample index (since the start of the stream) of pending[0].
+        self.index = 0
+        self.psd = np.zeros(len(self.freqs))
+        self.windows = 0
+
+    def update(self, x):
+        """
+        Feed new samples. Returns (index, columns): the absolute sample index
+        at which the first new window starts and the PSD of each new window,
+        shape (n_windows, nfft // 2 + 1). Windows start every hop samples.
+        """
+        buf = np.concatenate((self.pending, x)) if len(self.pending) else x
+        n = (len(buf) - self.nfft) // self.hop + 1 if len(buf) >= self.nfft else 0
+        index = self.index
+        if n == 0:
+            self.pending = np.array(buf, dtype=np.float64)
+            return index, np.empty((0, len(self.freqs)))
+
+        frames = sliding_window_view(buf, self.nfft)[:: self.hop][:n]
+        frames = frames - frames.mean(axis=1, keepdims=True)
+        columns = np.abs(np.fft.rfft(frames * self.window, axis=1)) ** 2 * self.scale
+
+        # Exponentially weighted Welch average over the new windows, seeded
+        # with the very first one.
+        new = columns
+        if self.windows == 0:
+            self.psd = columns[0]
+            new = columns[1:]
+        decay = (1.0 - self.alpha) ** np.arange(len(new) - 1, -1, -1)
+        self.psd = self.psd * (1.0 - self.alpha) ** len(new) + self.alpha * (
+            decay @ new
+        )
+        self.windows += n
+
+        consumed = n * self.hop
+        self.pending = np.array(buf[consumed:], dtype=np.float64)
+        self.index += consumed
+        return index, columns
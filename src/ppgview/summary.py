@@ -0,0 +1,375 @@
+import os
+import re
+import csv
+import glob
+import time
+import logging
+import datetime as dt
+
+from dataclasses import dataclass, fields
+from functools import partial
+
+import numpy as np
+
+from multiprocess import Pool
+
+from ppgview import packet
+from ppgview.capture import CaptureReader
+from ppgview.clock import ClockModel
+from ppgview.framer import Framer
+
+# Study triage: a signal-quality summary of many raw captures at once.
+#
+# Every capture is framed as a stream, straight from the memory-mapped file
+# for plain .in.bin captures and frame by frame for segmented ones, and cut
+# into blocks of `window` seconds at a constant configuration. Each block
+# gives a clipping count, a perfusion index and a heart-rate estimate from
+# the detect channel (IR if present), and a min/max envelope of every
+# channel for the thumbnail. Captures are spread over a process pool.
+
+# Heart-rate band (Hz) and the share of its power the spectral peak must
+# hold for the block to count as having a usable heart rate.
+HRBand = (0.5, 3.5)
+HRPeakWidth = 0.1  # Hz either side of the peak
+HRConfidence = 0.3
+
+ThumbnailColors = ("darkred", "red", "green", "blue", "purple")
+
+
+@dataclass
+class CaptureSummary:
+    capture: str
+    start: str = ""
+    duration: float = 0.0  # s of samples
+    packets: int = 0
+    packets_lost: int = 0
+    loss_rate: float = 0.0
+    gaps: int = 0
+    resyncs: int = 0
+    segments: int = 0
+    configs: str = ""
+    clipped: float = 0.0  # share of samples with any channel clipped
+    perfusion_index: float = float("nan")  # %, median over blocks
+    hr_coverage: float = float("nan")  # share of blocks with a usable heart rate
+    heart_rate: float = float("nan")  # bpm, median over those blocks
+    thumbnail: str = ""
+    error: str = ""
+
+
+def find_captures(paths):
+    """
+    Expand files, directories (searched recursively) and glob patterns to
+    capture paths: .in.bin files and the first segment of segmented ones.
+    """
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            matches = glob.glob(os.path.join(path, "**", "*"), recursive=True)
+        else:
+            matches = glob.glob(path) or [path]
+        for name in matches:
+            if name.endswith(".in.bin") or re.search(r"\.in\.\d{4}\.cap$", name):
+                found.append(re.sub(r"\.\d{4}\.cap$", ".0000.cap", name))
+    return sorted(set(found))
+
+
+class _Blocks:
+    # Per-block statistics of one capture, fed packet by packet.
+
+    def __init__(self, fmt, window, clip_level):
+        self.C = len(fmt)
+        self.detect = fmt.index("ir") if "ir" in fmt.channels else 0
+        self.window = window
+        self.limit = clip_level * 2**packet.ADCBits
+        self.pending = []
+        self.count = 0
+        self.samples = 0
+        self.duration = 0.0
+        self.clipped = 0
+        self.times = []
+        self.low = []
+        self.high = []
+        self.perfusion = []
+        self.rates = []
+        self.confident = []
+
+    def add(self, pkt, base):
+        if not self.pending:
+            self.t0 = base
+            self.fs = 1000.0 / pkt.dt
+            self.scale = pkt.scale
+        counts = pkt.samples.astype(np.float64)
+        self.pending.append(counts)
+        self.count += pkt.N
+        self.clipped += int((counts >= self.limit).any(axis=0).sum())
+        if self.count >= self.window * self.fs:
+            self.flush()
+
+    def flush(self):
+        # Close the current block, e.g. on a config change or gap.
+        if not self.pending:
+            return
+        x = np.concatenate(self.pending, axis=1)
+        self.pending = []
+        self.count = 0
+        self.samples += x.shape[1]
+        self.duration += x.shape[1] / self.fs
+
+        uA = x * self.scale
+        self.times.append(self.t0)
+        self.low.append(uA.min(axis=1))
+        self.high.append(uA.max(axis=1))
+
+        n = x.shape[1]
+        if n < self.window * self.fs / 2:
+            return
+        y = x[self.detect]
+        dc = y.mean()
+        if dc <= 0:
+            return
+        # Pulsatile part: detrended, robust peak to peak.
+        u = np.arange(n)
+        y = y - np.polyval(np.polyfit(u, y, 1), u)
+        ac = np.percentile(y, 95) - np.percentile(y, 5)
+        self.perfusion.append(100.0 * ac / dc)
+
+        nfft = 1 << int(np.ceil(np.log2(4 * n)))
+        power = np.abs(np.fft.rfft(y * np.hanning(n), nfft)) ** 2
+        freqs = np.fft.rfftfreq(nfft, 1.0 / self.fs)
+        band = (freqs >= HRBand[0]) & (freqs <= HRBand[1])
+        total = power[band].sum()
+        if total <= 0:
+            self.confident.append(False)
+            return
+        peak = freqs[band][np.argmax(power[band])]
+        near = band & (np.abs(freqs - peak) <= HRPeakWidth)
+        confident = power[near].sum() / total >= HRConfidence
+        self.confident.append(confident)
+        if confident:
+            self.rates.append(60.0 * peak)
+
+
+def _lost_across(last_pid, last_time, pkt):
+    # Packets lost over a dropout, from the pids either side of it; none if
+    # MCU time went back (the sensor rebooted, restarting its pids). pids
+    # wrap every 65536 packets, so MCU time tells how often they did.
+    step = (pkt.time - last_time) & 0xFFFFFFFF
+    if step >= 2**31:
+        return 0
+    lost = (pkt.pid - last_pid - 1) & 0xFFFF
+    expected = step / (pkt.N * pkt.dt) - 1
+    return lost + 0x10000 * max(round((expected - lost) / 0x10000), 0)
+
+
+def _scan(reader, fmt, clock, blocks, summary, gap_ms):
+    # Frame the whole capture. Kept apart so no packet views into the
+    # mapped file outlive it.
+    last_config = None
+    configs = []
+    last_end = None
+    across = None
+    lost_across = 0
+
+    def handle(pkt):
+        nonlocal last_config, last_end, across, lost_across
+        if across is not None:
+            lost_across += _lost_across(*across, pkt)
+            across = None
+        base, period = clock.update(pkt.time, pkt.N, pkt.dt)
+        if pkt.config != last_config or (
+            last_end is not None and abs(base - last_end) > gap_ms
+        ):
+            blocks.flush()
+        if pkt.config != last_config:
+            last_config = pkt.config
+            summary.segments += 1
+            config = (
+                f"{pkt.sample_rate / pkt.sample_avg:g} Hz "
+                f"{pkt.adc_range} nA {pkt.pulse_width} us"
+            )
+            if config not in configs:
+                configs.append(config)
+        last_end = base + pkt.N * period
+        blocks.add(pkt, base)
+
+    if reader.raw is not None:
+        framer = Framer(reader.raw, fmt=fmt)
+        for pkt in framer.packets(final=True):
+            handle(pkt)
+    else:
+        framer = Framer(fmt=fmt)
+        gaps = set(reader.gaps().tolist())
+        frame = None
+        for offset, data in reader.chunks():
+            if offset in gaps:
+                # Frames after a dropout don't continue the last.
+                for pkt in framer.packets(final=True):
+                    handle(pkt)
+                if framer.last_pid is not None:
+                    across = (framer.last_pid, framer.last_time)
+                framer.reset()
+                summary.gaps += 1
+            k = reader.find_offset(offset)
+            if k != frame:
+                # A frame's first marked packet may be in the one before.
+                frame = k
+                for j in range(k, min(k + 2, len(reader.frames))):
+                    anchor = reader.clock(j)
+                    if anchor is not None:
+                        clock.anchor(*anchor)
+            framer.feed(data)
+            for pkt in framer.packets():
+                handle(pkt)
+        for pkt in framer.packets(final=True):
+            handle(pkt)
+    blocks.flush()
+
+    summary.configs = "; ".join(configs)
+    summary.packets = framer.stats.packets
+    summary.packets_lost = framer.stats.packets_lost + lost_across
+    summary.resyncs = framer.stats.resyncs
+
+
+def summarize(
+    path,
+    out_dir=None,
+    fmt=packet.DefaultFormat,
+    window=10.0,
+    clip_level=0.98,
+    thumb_points=1000,
+):
+    """
+    Summarize one capture. With out_dir, a thumbnail is written there as
+    <capture>.svg. Errors are reported in the summary rather than raised,
+    so one bad file doesn't stop a study.
+    """
+    summary = CaptureSummary(capture=path)
+    try:
+        reader = CaptureReader(path)
+    except (OSError, ValueError) as e:
+        summary.error = str(e)
+        return summary
+
+    # Same timeline as a replay: the live clock's mapping recorded in the
+    # capture, or failing that MCU time from its start stamp.
+    clock = ClockModel(fit=False)
+    stamp = re.search(r"(\d{8}_\d{6})", os.path.basename(path))
+    if stamp:
+        start = dt.datetime.strptime(stamp.group(1), "%Y%m%d_%H%M%S")
+        clock.reset(start=start.timestamp() * 1000.0)
+        summary.start = start.isoformat()
+
+    blocks = _Blocks(fmt, window, clip_level)
+    try:
+        _scan(reader, fmt, clock, blocks, summary, gap_ms=window * 1000.0)
+    except Exception as e:
+        summary.error = f"{type(e).__name__}: {e}"
+    finally:
+        reader.close()
+
+    summary.duration = blocks.duration
+    summary.loss_rate = summary.packets_lost / max(
+        summary.packets + summary.packets_lost, 1
+    )
+    summary.clipped = blocks.clipped / max(blocks.samples, 1)
+    if blocks.perfusion:
+        summary.perfusion_index = float(np.median(blocks.perfusion))
+    if blocks.confident:
+        summary.hr_coverage = float(np.mean(blocks.confident))
+    if blocks.rates:
+        summary.heart_rate = float(np.median(blocks.rates))
+
+    if out_dir is not None and blocks.times:
+        name = os.path.basename(re.sub(r"\.(in\.bin|in\.\d{4}\.cap)$", "", path))
+        summary.thumbnail = os.path.join(out_dir, f"{name}.svg")
+        with open(summary.thumbnail, "w") as f:
+            f.write(
+                thumbnail(
+                    np.array(blocks.times),
+                    np.array(blocks.low).T,
+                    np.array(blocks.high).T,
+                    fmt.channels,
+                    name,
+                    thumb_points,
+                )
+            )
+    return summary
+
+
+def thumbnail(times, low, high, names, title, points=1000, width=600, height=80):
+    """
+    SVG of the min/max envelope of each channel, shape (C, n) at times (ms),
+    one panel per channel, reduced to at most `points` columns.
+    """
+    if len(times) > points:
+        cuts = np.linspace(0, len(times), points, endpoint=False).astype(np.intp)
+        times = times[cuts]
+        low = np.minimum.reduceat(low, cuts, axis=1)
+        high = np.maximum.reduceat(high, cuts, axis=1)
+
+    span = max(times[-1] - times[0], 1.0)
+    x = (times - times[0]) / span * width
+    top = 16
+    out = [
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" '
+        f'height="{top + height * len(names)}" font-family="sans-serif" '
+        f'font-size="11">',
+        f'<text x="2" y="12">{title} ({span / 3.6e6:.1f} h)</text>',
+    ]
+    for c, name in enumerate(names):
+        lo, hi = low[c], high[c]
+        y0, y1 = np.nanmin(lo), np.nanmax(hi)
+        scale = (height - 4) / max(y1 - y0, 1e-12)
+        base = top + (c + 1) * height - 2
+        outline = np.concatenate(
+            (
+                np.stack((x, base - (hi - y0) * scale), axis=1),
+                np.stack((x, base - (lo - y0) * scale), axis=1)[::-1],
+            )
+        )
+        points_attr = " ".join(f"{px:.1f},{py:.1f}" for px, py in outline.tolist())
+        color = ThumbnailColors[c % len(ThumbnailColors)]
+        out.append(
+            f'<polygon points="{points_attr}" fill="{color}" '
+            f'fill-opacity="0.6" stroke="{color}" stroke-width="0.5"/>'
+        )
+        out.append(f'<text x="2" y="{base - height + 16}">{name}</text>')
+    out.append("</svg>")
+    return "\n".join(out) + "\n"
+
+
+def summarize_all(paths, out_dir, fmt=packet.DefaultFormat, jobs=None, **options):
+    """
+    Summarize every capture under paths in parallel and write
+    out_dir/summary.csv and the thumbnails. Returns the summaries.
+    """
+    log = logging.getLogger("summary")
+    captures = find_captures(paths)
+    os.makedirs(out_dir, exist_ok=True)
+    log.info(
+        f"Summarizing {len(captures)} captures with {jobs or os.cpu_count()} workers."
+    )
+
+    started = time.monotonic()
+    summaries = []
+    work = partial(summarize, out_dir=out_dir, fmt=fmt, **options)
+    with Pool(jobs) as pool:
+        for summary in pool.imap_unordered(work, captures):
+            if summary.error:
+                log.warning(f"{summary.capture}: {summary.error}")
+            summaries.append(summary)
+    summaries.sort(key=lambda s: s.capture)
+
+    table = os.path.join(out_dir, "summary.csv")
+    with open(table, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow([field.name for field in fields(CaptureSummary)])
+        for summary in summaries:
+            writer.writerow(
+                [getattr(summary, field.name) for field in fields(CaptureSummary)]
+            )
+    log.info(
+        f"Wrote {table} in {time.monotonic() - started:.1f} s "
+        f"({sum(s.duration for s in summaries) / 3600:.1f} h of data)."
+    )
+    return summaries